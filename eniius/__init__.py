@@ -1,14 +1,35 @@
+import importlib
 import warnings
-try:
-    from . import mcstas
-    from . import horace
-    from . import nexus
-    from .eniius import Eniius
-except ModuleNotFoundError as e:
-    import traceback
-    warnings.warn('Could not import submodule')
-    traceback.print_tb(e.__traceback__)
-    print(e)
-
-from . import _version
-__version__ = _version.get_versions()['version']
+
+# Submodules (and their heavy dependencies: mcstasscript, scipy, nexusformat)
+# are only imported on first access, e.g. `eniius.horace` or `eniius.Eniius`
+_SUBMODULES = ['mcstas', 'horace', 'nexus', 'writer', 'spe', 'instr', 'comps']
+_ATTRIBUTES = {'Eniius': 'eniius', 'NXSPEData': 'spe', 'NXSPEReference': 'spe', 'ExportFuture': 'writer'}
+
+
+def _import_submodule(name):
+    try:
+        return importlib.import_module(f'.{name}', __name__)
+    except ModuleNotFoundError as e:
+        warnings.warn(f'Could not import submodule "{name}": {e}')
+        raise
+
+
+def __getattr__(name):
+    if name == '__version__':
+        # Uses a cached record rather than running git (via versioneer) on import
+        from ._version_record import get_version
+        value = get_version()
+        globals()[name] = value
+        return value
+    elif name in _SUBMODULES:
+        return _import_submodule(name)
+    elif name in _ATTRIBUTES:
+        value = getattr(_import_submodule(_ATTRIBUTES[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + ['__version__'] + _SUBMODULES + list(_ATTRIBUTES.keys()))
@@ -0,0 +1,123 @@
+# Caches the versioneer version string so that `eniius.__version__` does not run git on every import.
+# Installed (built) packages already have a static _version.py so this only matters in source checkouts,
+# where the record is keyed on the checked out commit, the tags and the tracked files which have changed (so the
+# "dirty" state of the working tree), read directly from the .git folder.
+import hashlib
+import struct
+import json
+import os
+
+THISFOLDER = os.path.dirname(os.path.realpath(__file__))
+RECORD_FILE = os.path.join(THISFOLDER, '_version_record.json')
+
+
+def _get_gitdir(root):
+    gitdir = os.path.join(root, '.git')
+    if os.path.isfile(gitdir):
+        # Worktrees and submodules have a file pointing to the actual git folder
+        with open(gitdir, 'r') as f:
+            gitdir = os.path.join(root, f.read().strip().replace('gitdir: ', ''))
+    return gitdir if os.path.isdir(gitdir) else None
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _read_packed_ref(gitdir, ref):
+    try:
+        with open(os.path.join(gitdir, 'packed-refs'), 'r') as f:
+            head = [l.split()[0] for l in f if l.strip().endswith(' ' + ref)]
+    except OSError:
+        return ref
+    return head[0] if head else ref
+
+
+def _changed_files(gitdir, root):
+    # Returns a key of the tracked files whose size or modification time differ from those in the git index
+    # (which is how git first checks for changes), so it changes when the working tree becomes dirty or clean.
+    # Only index versions 2 and 3 are parsed; for others the key is the modification time of the index.
+    index = os.path.join(gitdir, 'index')
+    try:
+        with open(index, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return ''
+    if data[:4] != b'DIRC' or struct.unpack('>I', data[4:8])[0] not in (2, 3):
+        return str(_mtime(index))
+    version, count = struct.unpack('>II', data[4:12])
+    pos, changed = 12, []
+    for _ in range(count):
+        mtime, mtime_ns, mode, size = [struct.unpack('>I', data[(pos + i):(pos + i + 4)])[0] for i in (8, 12, 24, 36)]
+        flags = struct.unpack('>H', data[(pos + 60):(pos + 62)])[0]
+        i0 = pos + (64 if version == 3 and flags & 0x4000 else 62)
+        i1 = data.index(b'\0', i0)
+        path = data[i0:i1].decode('utf-8', 'replace')
+        # Entries are padded with 1-8 null bytes to a multiple of 8 bytes
+        pos += (i1 - pos + 8) // 8 * 8
+        if (mode >> 12) == 0b1110 or flags & 0x8000:  # Submodules and "assume unchanged" files
+            continue
+        try:
+            st = os.stat(os.path.join(root, path))
+        except OSError:
+            changed.append(f'{path}:deleted')
+            continue
+        if (st.st_size & 0xffffffff) != size or st.st_mtime_ns // 10**9 != mtime or \
+                (mtime_ns != 0 and st.st_mtime_ns % 10**9 != mtime_ns):
+            changed.append(f'{path}:{st.st_size}:{st.st_mtime_ns}')
+    return hashlib.sha1('\n'.join(changed).encode()).hexdigest()[:16] if changed else ''
+
+
+def source_key(root=None):
+    # Returns a key which identifies the git state of a source checkout, or None if not a git checkout
+    root = os.path.dirname(THISFOLDER) if root is None else root
+    gitdir = _get_gitdir(root)
+    if gitdir is None:
+        return None
+    try:
+        with open(os.path.join(gitdir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+    if head.startswith('ref: '):
+        ref = head[5:]
+        try:
+            with open(os.path.join(gitdir, ref), 'r') as f:
+                head = f.read().strip()
+        except OSError:
+            head = _read_packed_ref(gitdir, ref)
+    tags = (_mtime(os.path.join(gitdir, 'refs', 'tags')), _mtime(os.path.join(gitdir, 'packed-refs')))
+    return f'{head}:{tags[0]}:{tags[1]}:{_changed_files(gitdir, root)}'
+
+
+def get_version():
+    # Returns the version string, only calling versioneer (and hence git) if the record is out of date
+    key = source_key()
+    if key is not None:
+        try:
+            with open(RECORD_FILE, 'r') as f:
+                record = json.load(f)
+            if record['key'] == key:
+                return record['version']
+        except (OSError, ValueError, KeyError):
+            pass
+    from . import _version
+    version = _version.get_versions()['version']
+    if key is not None:
+        try:
+            with open(RECORD_FILE, 'w') as f:
+                json.dump({'key':key, 'version':version}, f)
+        except OSError:
+            pass
+    return version
+
+
+def clear():
+    # Removes the version record so that the next access to `eniius.__version__` calls versioneer
+    try:
+        os.remove(RECORD_FILE)
+    except FileNotFoundError:
+        pass
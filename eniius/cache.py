@@ -0,0 +1,183 @@
+import numpy as np
+import hashlib
+import pickle
+import tempfile
+import os
+
+# Folder for persistent caches of parsed data; set ENIIUS_CACHE_DIR to override or to '' to disable caching
+CACHE_DIR = os.environ.get('ENIIUS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'eniius'))
+CACHES = {}
+
+
+def file_hash(filename, *extra):
+    # Returns a hash of the contents of a file (together with any extra key strings)
+    hsh = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            hsh.update(block)
+    for ex in extra:
+        hsh.update(str(ex).encode())
+    return hsh.hexdigest()
+
+
+def clear_cache(name=None):
+    # Removes all entries in a named cache, or in all caches if no name is given
+    for cache_name, cache in CACHES.items():
+        if name is None or name == cache_name:
+            cache.invalidate()
+
+
+class DiskCache():
+    # A size-limited on-disk cache of files in a subfolder of CACHE_DIR, with least-recently-used eviction
+
+    def __init__(self, name, max_size=100*2**20, max_entries=256):
+        self.name = name
+        self.max_size = max_size
+        self.max_entries = max_entries
+        CACHES[name] = self
+
+    @property
+    def enabled(self):
+        return bool(CACHE_DIR)
+
+    @property
+    def folder(self):
+        return os.path.join(CACHE_DIR, self.name)
+
+    def key(self, filename, *extra):
+        # Cache keys depend on the file contents and the eniius version (so are invalidated by upgrades)
+        from . import __version__
+        return file_hash(filename, __version__, *extra)
+
+    def stat_key(self, filename, *extra):
+        # Cheaper key for large (read-only) data files using the file path, size and modification time
+        from . import __version__
+        st = os.stat(filename)
+        hsh = hashlib.sha256()
+        for ex in [os.path.realpath(filename), st.st_size, st.st_mtime_ns, __version__, *extra]:
+            hsh.update(str(ex).encode())
+        return hsh.hexdigest()
+
+    def path(self, key, ext='.pkl'):
+        return os.path.join(self.folder, key + ext)
+
+    def get(self, key, ext='.pkl'):
+        # Returns the path to a cached file if it exists (and marks it as recently used) or None
+        if not self.enabled:
+            return None
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, writer, ext='.pkl'):
+        # Writes a cache entry atomically using writer(file_object); returns the path or None
+        if not self.enabled:
+            return None
+        path = self.path(key, ext)
+        tmpfile = None
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            # A unique temporary file, as other threads (or processes) may be saving the same key
+            fd, tmpfile = tempfile.mkstemp(dir=self.folder, prefix=key, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                writer(f)
+            os.replace(tmpfile, path)
+        except (OSError, pickle.PicklingError):
+            if tmpfile is not None and os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            return None
+        self.evict()
+        return path
+
+    def load(self, key):
+        # Loads a pickled object from the cache, returns None if it is not cached
+        path = self.get(key)
+        if path is not None:
+            try:
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                self.invalidate(key)
+        return None
+
+    def save(self, key, obj):
+        return self.put(key, lambda f: pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def load_arrays(self, key, mmap_mode='r'):
+        # Loads a dictionary of arrays saved with save_arrays (memory-mapped by default), or None
+        path = self.get(key, ext='')
+        if path is not None:
+            try:
+                return {fn[:-4]:np.load(os.path.join(path, fn), mmap_mode=mmap_mode, allow_pickle=False)
+                        for fn in os.listdir(path) if fn.endswith('.npy')}
+            except (OSError, ValueError):
+                self.invalidate(key)
+        return None
+
+    def save_arrays(self, key, arrays):
+        # Saves a dictionary of arrays as a folder of (memory-mappable) .npy files; returns the path or None
+        if not self.enabled:
+            return None
+        path = self.path(key, ext='')
+        tmpdir = None
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            # A unique temporary folder, as other threads (or processes) may be saving the same key
+            tmpdir = tempfile.mkdtemp(dir=self.folder, prefix=key, suffix='.tmp')
+            for k, v in arrays.items():
+                np.save(os.path.join(tmpdir, f'{k}.npy'), np.asarray(v), allow_pickle=False)
+            self._remove(path)
+            os.replace(tmpdir, path)
+        except OSError:
+            if tmpdir is not None:
+                self._remove(tmpdir)
+            return None
+        self.evict()
+        return path
+
+    def entries(self):
+        # Returns a list of (path, size, last_used) for all entries in the cache
+        if not os.path.isdir(self.folder):
+            return []
+        entries = []
+        for fn in os.listdir(self.folder):
+            path = os.path.join(self.folder, fn)
+            if fn.endswith('.tmp'):
+                continue
+            try:
+                size = sum([os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)]) \
+                    if os.path.isdir(path) else os.path.getsize(path)
+                entries.append((path, size, os.stat(path).st_mtime_ns))
+            except OSError:
+                pass
+        return entries
+
+    def evict(self):
+        # Removes least recently used entries until the cache is within its size and number limits
+        entries = sorted(self.entries(), key=lambda x: x[2])
+        total = sum([e[1] for e in entries])
+        while entries and (total > self.max_size or len(entries) > self.max_entries):
+            path, size, _ = entries.pop(0)
+            self._remove(path)
+            total -= size
+
+    def invalidate(self, key=None):
+        # Removes a single entry (all files with this key) or all entries if key is None
+        for path, _, _ in self.entries():
+            if key is None or os.path.basename(path).startswith(key):
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            if os.path.isdir(path):
+                for fn in os.listdir(path):
+                    os.remove(os.path.join(path, fn))
+                os.rmdir(path)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
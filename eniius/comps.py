@@ -0,0 +1,213 @@
+import threading
+import copy
+import re
+import os
+
+from .cache import DiskCache
+from .mcstas import comps_path
+
+# Folders of the component library which are searched for components (as by mcstasscript)
+COMP_FOLDERS = ['sources', 'optics', 'samples', 'monitors', 'misc', 'contrib', 'obsolete', 'union', 'astrox', 'sasmodels']
+# Version of the index format; increment when CompInfo or the parsing changes
+INDEX_VERSION = 1
+COMPS_CACHE = DiskCache('comps', max_size=20*2**20, max_entries=16)
+_INDEXES = {}
+_index_lock = threading.Lock()
+_reader_lock = threading.Lock()
+IndexedMcStasInstr = None
+
+
+class CompInfo():
+    # Parameters of a McStas component definition, with the same attributes as mcstasscript's ComponentInfo
+    # (parameter units and comments, which are only used for help text, are not read)
+
+    def __init__(self, name, path, category, parameter_names, parameter_defaults, parameter_types):
+        self.name = name
+        self.path = path
+        self.category = category
+        self.parameter_names = parameter_names
+        self.parameter_defaults = parameter_defaults
+        self.parameter_types = parameter_types
+        self.parameter_units = {}
+        self.parameter_comments = {}
+
+
+def _strip_c_comments(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    return re.sub(r'//[^\n]*', '', text)
+
+
+def _split_parameters(text):
+    # Splits a parameter list at commas which are not within braces (vector defaults)
+    parts, depth, i0 = [], 0, 0
+    for ii, ch in enumerate(text):
+        if ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+        elif ch == ',' and depth == 0:
+            parts.append(text[i0:ii])
+            i0 = ii + 1
+    return parts + [text[i0:]]
+
+
+def _c_int(value):
+    base = 16 if value[:2] in ('0x', '0X') else 2 if value[:2] in ('0b', '0B') else \
+        8 if len(value) > 1 and value[0] == '0' else 10
+    return int(value, base)
+
+
+def read_comp_file(path, category=None):
+    # Reads the definition and setting parameters (names, default values and types) of a .comp file,
+    # converting default values as mcstasscript does
+    with open(path, 'r') as f:
+        text = f.read()
+    name = os.path.basename(path)[:-5]
+    category = os.path.basename(os.path.dirname(path)) if category is None else category
+    info = CompInfo(name, path, category, [], {}, {})
+    match = re.search(r'^\s*((DEFINITION|SETTING) PARAMETERS.*?)^\s*(SHARE|INITIALI[SZ]E|USERVARS|DECLARE|TRACE|'
+                      r'DEPENDENCY|NOACC)', text, flags=re.S | re.M | re.I)
+    if match is None:
+        return info
+    sections = re.split(r'\s*(DEFINITION PARAMETERS|SETTING PARAMETERS|OUTPUT PARAMETERS)\s*',
+                        _strip_c_comments(match.group(1)))
+    parameters = ''
+    for ii, section in enumerate(sections[:-1]):
+        if section in ('DEFINITION PARAMETERS', 'SETTING PARAMETERS'):
+            parameters += sections[ii + 1].strip('(').strip(')') + ', '
+    for part in _split_parameters(parameters.replace('\n', ' ')):
+        words = part.strip().split(' ')
+        ptype = words[0] if words[0] in ('int', 'string', 'double', 'vector') else 'double'
+        part = (''.join(words[1:]) if words[0] == ptype else part).replace(' ', '')
+        if part == '':
+            continue
+        pname, _, value = part.partition('=')
+        if not _:
+            value = None
+        elif ptype == 'double':
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        elif ptype == 'int':
+            value = _c_int(value)
+        info.parameter_names.append(pname)
+        info.parameter_defaults[pname] = value
+        info.parameter_types[pname] = ptype
+    return info
+
+
+def build_index(library=comps_path):
+    # Scans the component library and returns {component name: CompInfo}
+    index = {}
+    for folder in COMP_FOLDERS:
+        for root, _, files in os.walk(os.path.join(library, folder)):
+            for fn in sorted(files):
+                if fn.endswith('.comp'):
+                    info = read_comp_file(os.path.join(root, fn))
+                    index[info.name] = info
+    return index
+
+
+def _index_key(library):
+    # The index is rebuilt if eniius, the index format or the library folders change (set by the modification
+    # times of the category folders, which change when components are added or removed). Call
+    # clear_cache('comps') after editing a component file in place.
+    mtimes = [os.stat(os.path.join(library, f)).st_mtime_ns if os.path.isdir(os.path.join(library, f)) else None
+              for f in COMP_FOLDERS]
+    return COMPS_CACHE.stat_key(library, INDEX_VERSION, *mtimes)
+
+
+def get_index(library=comps_path, use_cache=True):
+    # Returns the component index of a library; it is loaded once per process, from the disk cache if possible
+    library = os.path.realpath(library)
+    with _index_lock:
+        if library not in _INDEXES:
+            index = None
+            if use_cache and COMPS_CACHE.enabled:
+                key = _index_key(library)
+                index = COMPS_CACHE.load(key)
+            if index is None:
+                index = build_index(library)
+                if use_cache and COMPS_CACHE.enabled:
+                    COMPS_CACHE.save(key, index)
+            _INDEXES[library] = index
+        return _INDEXES[library]
+
+
+def get_component(component_name, library=comps_path, work_dir='.'):
+    # Returns the CompInfo of a component; definitions in the work directory take precedence over the library
+    local = os.path.join(work_dir, f'{component_name}.comp')
+    if os.path.isfile(local):
+        return read_comp_file(local, 'work directory')
+    try:
+        return get_index(library)[component_name]
+    except KeyError:
+        raise NameError(f'No component named {component_name} in McStas installation or current work directory.')
+
+
+class IndexedComponentReader():
+    # Stand-in for mcstasscript's ComponentReader which looks up components in the index of the library
+    # rather than scanning and parsing all the component files
+
+    def __init__(self, mcstas_path, input_path='.'):
+        self.mcstas_path = mcstas_path
+        index = get_index(mcstas_path)
+        self.component_path = {k:v.path for k, v in index.items()}
+        self.component_category = {k:v.category for k, v in index.items()}
+        self.load_components_from_folder(input_path, 'work directory')
+
+    def load_components_from_folder(self, folder, name, verbose=False):
+        if os.path.isdir(folder):
+            for fn in os.listdir(folder):
+                if fn.endswith('.comp'):
+                    self.component_path[fn[:-5]] = os.path.join(folder, fn)
+                    self.component_category[fn[:-5]] = name
+
+    def read_name(self, component_name):
+        if component_name not in self.component_path:
+            raise NameError(f'No component named {component_name} in McStas installation or current work directory.')
+        index = get_index(self.mcstas_path)
+        info = index.get(component_name, None)
+        if info is None or info.path != self.component_path[component_name]:
+            info = read_comp_file(self.component_path[component_name], self.component_category[component_name])
+        # A copy, as mcstasscript keeps these in the classes of the components it creates
+        return copy.deepcopy(info)
+
+    def read_component_file(self, absolute_path):
+        return read_comp_file(absolute_path)
+
+
+def _indexed_instr_class():
+    # Returns a mcstasscript McStas_instr subclass which reads components with an IndexedComponentReader
+    # (defined on first use as mcstasscript is slow to import). McStas_instr.__init__ still creates (and discards)
+    # its own ComponentReader, which lists the library folders but does not parse the component files
+    global IndexedMcStasInstr
+    with _reader_lock:
+        if IndexedMcStasInstr is None:
+            import mcstasscript  # Deferred as it is slow to import
+
+            class IndexedMcStasInstr(mcstasscript.McStas_instr):
+
+                def __init__(self, name, **kwargs):
+                    super().__init__(name, **kwargs)
+                    self._index_reader()
+
+                def clear_search(self):
+                    # mcstasscript recreates its ComponentReader here
+                    super().clear_search()
+                    self._index_reader()
+
+                def _index_reader(self):
+                    self.component_reader = IndexedComponentReader(self._run_settings['package_path'],
+                                                                   input_path=self._run_settings['run_path'])
+
+            # A module attribute (as mcstasscript does for its component classes) so instruments can be pickled
+            IndexedMcStasInstr.__qualname__ = 'IndexedMcStasInstr'
+        return IndexedMcStasInstr
+
+
+def new_instr(name, library=comps_path, **kwargs):
+    # Creates a mcstasscript McStas_instr whose components are looked up in the index of the library,
+    # rather than by parsing the library component files for each instrument
+    return _indexed_instr_class()(name, package_path=library, **kwargs)
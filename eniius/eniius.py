@@ -1,12 +1,43 @@
-from .mcstas import NXMcStas, get_instr
-from .writer import Writer
+from .mcstas import NXMcStas, get_instr_record
+from .writer import Writer, ExportFuture, export_progress
 from .nexus import NXinst2McStas, get_nx_component
 from nexusformat.nexus import nxload, NXfermi_chopper, NXinstrument, NXfield
+import concurrent.futures
+import h5py
+import threading
+import time
+import os
+
+EXPORT_FORMATS = ['icp', 'nxspe', 'json']
+EXPORT_EXTENSIONS = {'icp':'.nxs', 'nxspe':'.nxspe', 'json':'.json'}
+# Number of worker threads for background exports (see Eniius.submit)
+EXPORT_WORKERS = 4
+_export_pool = None
+_export_pool_lock = threading.Lock()
+
+
+def _export(writer, fmt, filename, kwargs):
+    # Writes one output format and returns the time taken (a module function so it can run in a worker process)
+    t0 = time.perf_counter()
+    getattr(writer, f'to_{fmt}')(filename, **kwargs)
+    return time.perf_counter() - t0
+
+
+def _background_pool():
+    # The worker pool shared by all background exports, created on first use
+    global _export_pool
+    with _export_pool_lock:
+        if _export_pool is None:
+            _export_pool = concurrent.futures.ThreadPoolExecutor(max_workers=EXPORT_WORKERS,
+                                                                 thread_name_prefix='eniius-export')
+        return _export_pool
 
 
 class Eniius:
 
     def __init__(self, nxs_obj=None, detector_dat=None, ei=None):
+        self._lock = threading.RLock()
+        self._writer = None
         self.nxs_obj = nxs_obj
         self.detector_dat = detector_dat
         self.ei = ei
@@ -17,27 +48,170 @@ class Eniius:
                 self.ei = fermi.energy.nxvalue
 
 
-    def to_icp(self, filename):
+    # The Writer and state derived from it (parsed detector tables, JSON text) are kept between calls and
+    # are discarded when nxs_obj, detector_dat or ei are set, or the nxs_obj tree is changed (as tracked
+    # by the nexusformat changed flag)
+    @property
+    def nxs_obj(self):
+        return self._nxs_obj
+
+
+    @nxs_obj.setter
+    def nxs_obj(self, value):
+        self._nxs_obj = value
+        self._writer = None
+
+
+    @property
+    def detector_dat(self):
+        return self._detector_dat
+
+
+    @detector_dat.setter
+    def detector_dat(self, value):
+        self._detector_dat = value
+        self._writer = None
+
+
+    @property
+    def ei(self):
+        return self._ei
+
+
+    @ei.setter
+    def ei(self, value):
+        self._ei = value
+        self._writer = None
+
+
+    @property
+    def writer(self):
+        with self._lock:
+            if self._writer is None or self._nxs_obj.changed:
+                self._writer = Writer(self._nxs_obj)
+                self._json = {}
+                self._nxs_obj.set_unchanged()
+            return self._writer
+
+
+    def to_icp(self, filename, backend=None, template=None, link=False):
         if not filename.endswith('.nxs'):
             filename += '.nxs'
-        writer = Writer(self.nxs_obj)
-        writer.to_icp(filename, self.detector_dat)
+        self.writer.to_icp(filename, self.detector_dat, backend=backend, template=template, link=link)
 
 
-    def to_json(self, filename):
+    def to_json(self, filename, stream=False, indent=4):
         if not filename.endswith('.json'):
             filename += '.json'
-        writer = Writer(self.nxs_obj)
-        writer.to_json(filename)
+        writer = self.writer
+        if stream:
+            writer.to_json(filename, stream=True, indent=indent)
+        else:
+            if indent not in self._json:
+                self._json[indent] = writer.json_text(indent)
+            with open(filename, 'w') as f:
+                f.write(self._json[indent])
 
 
-    def to_nxspe(self, filename):
+    def to_nxspe(self, filename, backend=None, storage='auto', template=None, link=False, data=None):
         if self.ei is None:
             raise RuntimeError('NXS instrument has no incident energy set. Cannot write NXSPE file')
         if not filename.endswith('.nxspe'):
             filename += '.nxspe'
-        writer = Writer(self.nxs_obj)
-        writer.to_nxspe(filename, self.ei, self.detector_dat)
+        self.writer.to_nxspe(filename, self.ei, self.detector_dat, backend=backend, storage=storage,
+                        template=template, link=link, data=data)
+
+
+    def export(self, filename, formats=('icp', 'nxspe', 'json'), backend=None, parallel='thread', max_workers=None,
+               template=None, link=False, indent=4):
+        # Writes several output formats (to filename with the format extension) sharing a single Writer and
+        # the parsed detector.dat. The outputs are written concurrently in a thread (or process) pool, except
+        # that writes with the nexus backend are made one at a time as nexusformat is not thread-safe (use the
+        # h5py backend for concurrent writes). indent is that of the JSON output.
+        # Returns a dictionary of the time taken for each format (and the total time)
+        # If an instrument template file is given (see Writer.write_template) it is created (or rebuilt if it is out
+        # of date) before the outputs
+        t0 = time.perf_counter()
+        for fmt in formats:
+            if fmt not in EXPORT_FORMATS:
+                raise RuntimeError(f'Unknown export format "{fmt}"')
+        if 'nxspe' in formats and self.ei is None:
+            raise RuntimeError('NXS instrument has no incident energy set. Cannot write NXSPE file')
+        # A filename given with one of the output extensions is used as the base name of all the outputs
+        for ext in EXPORT_EXTENSIONS.values():
+            if filename.endswith(ext):
+                filename = filename[:-len(ext)]
+                break
+        filenames = {fmt:filename + EXPORT_EXTENSIONS[fmt] for fmt in formats}
+        writer = self.writer
+        # A detector.dat is parsed once here for all the outputs (an HDF5 detector file is referenced, not parsed)
+        if self.detector_dat is not None and any([fmt != 'json' for fmt in formats]) \
+                and not h5py.is_hdf5(self.detector_dat):
+            writer._det_tables(self.detector_dat)
+        if template is not None:
+            writer.update_template(template, self.detector_dat)
+        kwargs = {'icp': {'det_file':self.detector_dat, 'backend':backend, 'template':template, 'link':link},
+                  'nxspe': {'ei':self.ei, 'det_file':self.detector_dat, 'backend':backend, 'template':template,
+                            'link':link},
+                  'json': {'stream':True, 'indent':indent}}
+        if parallel is None:
+            timings = {fmt:_export(writer, fmt, filenames[fmt], kwargs[fmt]) for fmt in formats}
+        else:
+            pool = {'thread':concurrent.futures.ThreadPoolExecutor,
+                    'process':concurrent.futures.ProcessPoolExecutor}[parallel]
+            with pool(max_workers=max_workers or len(formats)) as executor:
+                futures = {fmt:executor.submit(_export, writer, fmt, filenames[fmt], kwargs[fmt])
+                           for fmt in formats}
+                timings = {fmt:fut.result() for fmt, fut in futures.items()}
+        timings['total'] = time.perf_counter() - t0
+        return timings
+
+
+    def submit(self, fmt, filename, progress=None, **kwargs):
+        # Writes one output format ('icp', 'nxspe' or 'json') in a background thread and returns an ExportFuture
+        # whose result is the output file name. kwargs are passed to the to_<fmt> method. The instrument is
+        # serialised entirely in the worker, so the caller is not blocked (the nxs_obj tree should not be
+        # changed until the export is done). progress is an optional function called in the worker thread as
+        # progress(stage, fraction). A cancelled export stops at its next progress point and its partial output
+        # is removed (an existing file of the same name is only replaced when the export is done). With the nexus
+        # backend the file is written by nexusformat, which has no progress points, so a cancel while that write
+        # is in progress takes effect (in the worker) only once it is done; the future is cancelled at once.
+        # From an event loop, use `await asyncio.wrap_future(future)`.
+        if fmt not in EXPORT_FORMATS:
+            raise RuntimeError(f'Unknown export format "{fmt}"')
+        if fmt == 'nxspe' and self.ei is None:
+            raise RuntimeError('NXS instrument has no incident energy set. Cannot write NXSPE file')
+        ext = EXPORT_EXTENSIONS[fmt]
+        filename = filename if filename.endswith(ext) else filename + ext
+        future = ExportFuture(progress)
+        _background_pool().submit(self._run_export, future, fmt, filename, kwargs)
+        return future
+
+
+    def _run_export(self, future, fmt, filename, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        # The output is written to a temporary file (in the same directory) which only replaces filename once
+        # the export is done, so a cancelled or failed export leaves any existing file untouched
+        ext = EXPORT_EXTENSIONS[fmt]
+        tmpfile = f'{filename[:-len(ext)]}.{os.getpid()}.{threading.get_ident()}.tmp{ext}'
+        try:
+            with export_progress(future):
+                future.report('start', 0.)
+                getattr(self, f'to_{fmt}')(tmpfile, **kwargs)
+                future.report('done', 1.)
+        except (concurrent.futures.CancelledError, Exception) as err:
+            future.finish(tmpfile, filename, err)
+        else:
+            future.finish(tmpfile, filename)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+
+    def inject(self, filename, entry=None, template=None, link=False):
+        # Writes (or replaces) the instrument group of an existing NeXus file; returns True if it was modified
+        return self.writer.inject(filename, self.detector_dat, entry=entry, template=template, link=link)
 
 
     def to_mcstas(self):
@@ -75,8 +249,8 @@ class Eniius:
 
 
     @classmethod
-    def from_mcstas(cls, infile, detector_dat=None, ei=None):
-        mcstas_obj = get_instr(infile)
+    def from_mcstas(cls, infile, detector_dat=None, ei=None, use_cache=True, parser='auto'):
+        mcstas_obj = get_instr_record(infile, use_cache, parser)
         nxs_obj = NXMcStas(mcstas_obj.component_list).NXinstrument()
         nxs_obj['name'] = NXfield(value=mcstas_obj.name)
         return cls(nxs_obj, detector_dat, ei)
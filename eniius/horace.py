@@ -1,71 +1,117 @@
 import numpy as np
-import scipy.io
 import os
 
 from nexusformat.nexus import *
+from .cache import DiskCache
 
 THISFOLDER = os.path.dirname(os.path.realpath(__file__))
 MOD_TABLES = {}
+MOD_CACHE = DiskCache('moderator', max_size=200*2**20, max_entries=16)
+MOD_TMAX = 2000
 LET_TABLES = None
+LET_CACHE = DiskCache('let', max_size=16*2**20, max_entries=4)
 MU_ = {'units':'metre'}
 INST_FACES = {'maps':'TS1_S01_Maps.mcstas', 'merlin':'TS1_S04_Merlin.mcstas', 'let':'TS2.imat'}
 
 
-def get_let_divergences(ei, version=2):
+def get_let_tables():
+    # Returns the LET divergence tables as flat arrays. The MATLAB file is converted once to a binary
+    # (memory-mapped) cache so later processes need neither scipy.io nor to parse the .mat file.
     global LET_TABLES
     if LET_TABLES is None:
-        LET_TABLES = scipy.io.loadmat(f'{THISFOLDER}/instruments/horace_let_tables.mat')
-    htab = LET_TABLES[f'ver{version}_horiz_div']
-    vtab = LET_TABLES[f'ver{version}_vert_div']
-    def get_div(divtab, lam0, typestr):
-        angdeg = divtab['angdeg'][0][0].flatten()
-        ang = angdeg * np.pi / 180.
-        lam = divtab['lam'][0][0].flatten()
-        S = divtab['S'][0][0]
-        if lam0 < lam[0] or lam0 > lam[-1]:
-            raise RuntimeError('The incident neutron wavelength lies outside the range of the divergence lookup table')
-        profile = np.array([np.interp(lam0, lam, S[ii,:]) for ii in range(len(ang))])
-        profile = (profile / np.sum(profile)) / np.mean(np.diff(ang))
-        return NXdata(signal=NXfield(profile, unit='', name='Normalised Beam Profile'),
-                      axes=NXfield(angdeg, unit='degree', name=typestr))
-    lam = np.sqrt(81.80420126 / ei)
-    hdiv = get_div(htab, lam, 'Horizontal Divergence')
-    vdiv = get_div(vtab, lam, 'Vertical Divergence')
+        matfile = os.path.join(THISFOLDER, 'instruments', 'horace_let_tables.mat')
+        key = LET_CACHE.stat_key(matfile)
+        LET_TABLES = LET_CACHE.load_arrays(key)
+        if LET_TABLES is None:
+            import scipy.io  # Deferred as it is only needed to convert the tables
+            mat = scipy.io.loadmat(matfile)
+            LET_TABLES = {}
+            for tabname in [k for k in mat.keys() if k.startswith('ver')]:
+                for fld in ['angdeg', 'lam']:
+                    LET_TABLES[f'{tabname}_{fld}'] = np.asarray(mat[tabname][fld][0][0], dtype=np.float64).flatten()
+                LET_TABLES[f'{tabname}_S'] = np.asarray(mat[tabname]['S'][0][0], dtype=np.float64)
+            LET_CACHE.save_arrays(key, LET_TABLES)
+    return LET_TABLES
+
+
+def interp_let_divergence(ei, version=2, direction='horiz'):
+    # Computes the normalised LET divergence profiles for one or more incident energies,
+    # interpolating all angle rows of the lookup table at once.
+    # Returns the angles (in degrees) and the profiles as an array of shape (len(ei), len(angles))
+    tab = get_let_tables()
+    tabname = f'ver{version}_{direction}_div'
+    angdeg, lam, S = (tab[f'{tabname}_angdeg'], tab[f'{tabname}_lam'], tab[f'{tabname}_S'])
+    lam0 = np.sqrt(81.80420126 / np.atleast_1d(np.asarray(ei, dtype=np.float64)))
+    if np.any(lam0 < lam[0]) or np.any(lam0 > lam[-1]):
+        raise RuntimeError('The incident neutron wavelength lies outside the range of the divergence lookup table')
+    il = np.clip(np.searchsorted(lam, lam0, side='right') - 1, 0, len(lam) - 2)
+    slope = (S[:,il+1] - S[:,il]) / (lam[il+1] - lam[il])
+    profile = (slope * (lam0 - lam[il]) + S[:,il]).T
+    ang = angdeg * np.pi / 180.
+    profile = (profile / np.sum(profile, axis=1)[:,np.newaxis]) / np.mean(np.diff(ang))
+    return angdeg, profile
+
+
+def _divergence_nxdata(angdeg, profile, typestr):
+    return NXdata(signal=NXfield(profile, unit='', name='Normalised Beam Profile'),
+                  axes=NXfield(angdeg, unit='degree', name=typestr))
+
+
+def get_let_divergences(ei, version=2):
+    angh, hprof = interp_let_divergence(ei, version, 'horiz')
+    angv, vprof = interp_let_divergence(ei, version, 'vert')
+    hdiv = _divergence_nxdata(angh, hprof[0], 'Horizontal Divergence')
+    vdiv = _divergence_nxdata(angv, vprof[0], 'Vertical Divergence')
     return hdiv, vdiv
 
 
 def load_mcstas_moderator(instrument):
+    # Parses the text ISIS McStas moderator table for an instrument
     modfile = os.path.join(THISFOLDER, 'mcstas-comps', 'contrib', 'ISIS_tables', INST_FACES[instrument])
     with open(modfile, 'r') as f:
         dat = f.read().replace('(','').replace(')','').split('\n')
-    id0, en, intens = (dat.index(' time '), [], [])
-    n = dat.index(' time ', id0 + 1) - id0 - 6
+    ids = [ii for ii, line in enumerate(dat) if line == ' time ']
+    n = ids[1] - ids[0] - 6
     # time data originally in ns, energy in MeV
-    t = np.loadtxt(dat[(id0+1):(id0+n)], usecols=(0)) / 100
-    dt = np.diff(t)
-    while True:
-        e0 = np.loadtxt(dat[id0-2].split()[2:5:2]) * 1.e9
-        i0 = np.loadtxt(dat[(id0+1):(id0+n)], usecols=(1))
-        en.append(np.mean(e0))
-        intens.append((i0[:-1] / dt) / (e0[1] - e0[0]))
-        try:
-            id0 = dat.index(' time ', id0 + 1)
-        except ValueError:
-            break
-    return {'en':np.log(en), 'intens':np.array(intens), 't':t}
+    e0 = np.array([dat[id0-2].split()[2:5:2] for id0 in ids], dtype=np.float64) * 1.e9
+    tab = np.loadtxt([line for id0 in ids for line in dat[(id0+1):(id0+n)]], usecols=(0, 1))
+    tab = tab.reshape(len(ids), n-1, 2)
+    t = tab[0,:,0] / 100
+    intens = (tab[:,:-1,1] / np.diff(t)) / (e0[:,1] - e0[:,0])[:,np.newaxis]
+    return {'en':np.log(np.mean(e0, axis=1)), 'intens':intens, 't':t}
 
 
-def get_moderator_time_pulse(instrument, ei):
+def get_moderator_table(instrument):
+    # Returns the moderator table for an instrument; the text file is converted once to a binary
+    # (memory-mapped) cache keyed on the table file so later processes do not need to parse it.
+    # The table also holds the Ei-independent pulse data: times below MOD_TMAX and their intensities
     instrument = instrument.lower()
-    global MOD_TABLES
     if instrument not in MOD_TABLES:
-        MOD_TABLES[instrument] = load_mcstas_moderator(instrument)
-    TMAX = 2000
-    t, en, intens = (MOD_TABLES[instrument]['t'], MOD_TABLES[instrument]['en'], MOD_TABLES[instrument]['intens'])
-    kp = np.where(t < TMAX)[0]
-    ie = np.where(en < np.log(ei))[0][-1]
-    frac = (np.log(ei) - en[ie]) / (en[ie+1] - en[ie])
-    return intens[ie,kp] + frac * (intens[ie+1,kp] - intens[ie,kp]), t[kp]
+        modfile = os.path.join(THISFOLDER, 'mcstas-comps', 'contrib', 'ISIS_tables', INST_FACES[instrument])
+        key = MOD_CACHE.stat_key(modfile, instrument, MOD_TMAX)
+        table = MOD_CACHE.load_arrays(key)
+        if table is None or 'pulse_intens' not in table:
+            table = load_mcstas_moderator(instrument)
+            kp = np.where(table['t'] < MOD_TMAX)[0]
+            table['pulse_t'] = table['t'][kp]
+            table['pulse_intens'] = np.ascontiguousarray(table['intens'][:,kp])
+            MOD_CACHE.save_arrays(key, table)
+        MOD_TABLES[instrument] = table
+    return MOD_TABLES[instrument]
+
+
+def get_moderator_time_pulse(instrument, ei):
+    # Returns the moderator time pulse (and time axis) for an incident energy; if ei is an array
+    # the pulses are returned as a 2D array of shape (len(ei), len(t))
+    table = get_moderator_table(instrument)
+    en, intens = (table['en'], table['pulse_intens'])
+    logei = np.log(np.atleast_1d(np.asarray(ei, dtype=np.float64)))
+    ie = np.searchsorted(en, logei, side='left') - 1
+    if np.any(ie < 0) or np.any(ie > len(en) - 2):
+        raise RuntimeError('The incident energy lies outside the range of the moderator table')
+    frac = ((logei - en[ie]) / (en[ie+1] - en[ie]))[:,np.newaxis]
+    pulse = intens[ie,:] + frac * (intens[ie+1,:] - intens[ie,:])
+    return (pulse if np.ndim(ei) > 0 else pulse[0]), np.asarray(table['pulse_t'])
 
 
 def get_fermi_data(instrument, freq, chopper):
@@ -94,15 +140,35 @@ def get_fermi_data(instrument, freq, chopper):
     return fermi_data
 
 
-def let_instrument(ei, freq=None):
+def _as_batch(ei, freq, default):
+    # Broadcasts a list of incident energies and (optionally) frequencies to lists of the same length
+    ei = np.atleast_1d(ei).tolist()
     if freq is None:
-        freq = [40., 240.]
+        freq = default
+    if np.ndim(freq) == np.ndim(default):
+        freq = [freq] * len(ei)
+    if len(freq) != len(ei):
+        raise RuntimeError('The number of frequencies must match the number of incident energies')
+    return ei, list(freq)
+
+
+def _common_group(**kwargs):
+    # Ei-independent groups are held in a collection so that they are copied (not moved) when
+    # assigned to each instrument in a batch
+    return NXcollection(**kwargs)
+
+
+def let_instrument(ei, freq=None):
+    return let_instruments([ei], None if freq is None else [freq])[0]
 
-    inst = NXinstrument(fermi=NXfermi_chopper(energy=ei))
-    inst['name'] = NXfield(value='LET', short_name='LET')
+
+def let_instruments(ei, freq=None):
+    # Builds LET instruments for an array of incident energies (and optionally of [shaping, mono]
+    # chopper frequencies). The Ei-independent parts are built once and copied into each instrument
+    ei, freq = _as_batch(ei, freq, [40., 240.])
     # Defines the Source
-    inst['source'] = NXsource(Name='ISIS', type='Spallation Neutron Source',
-                              frequency=NXfield(10, units='hertz'), target_material='W')
+    common = _common_group(source=NXsource(Name='ISIS', type='Spallation Neutron Source',
+                                           frequency=NXfield(10, units='hertz'), target_material='W'))
     # Defines the moderator
     d_mod = NXtransformations(MOD_T_AXIS=NXfield(-25., transformation_type='translation',
                                                  vector=[0.,0.,1.], depends_on='.', **MU_),
@@ -110,85 +176,103 @@ def let_instrument(ei, freq=None):
                                                  vector=[0.,1.,0.], depends_on='MOD_T_AXIS', units='degree'))
     pulse = NXnote(type='ikcarp', data=[42.1304,0,0],
                    description='Empirical Ikeda-Carpenter type moderator pulse model')
-    inst['moderator'] = NXmoderator(type='Liquid H2', temperature=NXfield(17., units='kelvin'),
-                                    empirical_pulse_shape=pulse, transforms=d_mod)
+    common['moderator'] = NXmoderator(type='Liquid H2', temperature=NXfield(17., units='kelvin'),
+                                      empirical_pulse_shape=pulse, transforms=d_mod)
     # Defines the divergences
-    hdiv, vdiv = get_let_divergences(ei)
-    inst['horiz_div'] = NXbeam(data=hdiv)
-    inst['vert_div'] = NXbeam(data=vdiv)
-    # Defines the choppers
+    angh, hprof = interp_let_divergence(ei, direction='horiz')
+    angv, vprof = interp_let_divergence(ei, direction='vert')
+    # Defines the choppers (rotation speeds are set per instrument)
     d_ch1 = NXtransformations(CH1_T_AXIS=NXfield(-17.17, transformation_type='translation',
                                                  vector=[0.,0.,1.], depends_on='.', **MU_))
     sl = np.rad2deg(np.arctan2(0.04, 0.28) / 2.)
-    inst['shaping_chopper'] = NXdisk_chopper(rotation_speed=NXfield(freq[0], units='hertz'), radius=NXfield(0.28, **MU_),
-                                             type='contra_rotating_pair', slit_edges=[-sl, sl], transforms=d_ch1)
+    common['shaping_chopper'] = NXdisk_chopper(rotation_speed=NXfield(0., units='hertz'), radius=NXfield(0.28, **MU_),
+                                               type='contra_rotating_pair', slit_edges=[-sl, sl], transforms=d_ch1)
     d_ch5 = NXtransformations(CH5_T_AXIS=NXfield(-1.5, transformation_type='translation',
                                                  vector=[0.,0.,1.], depends_on='.', **MU_))
     sl = np.rad2deg(np.arctan2(0.031, 0.28) / 2.)
-    inst['mono_chopper'] = NXdisk_chopper(rotation_speed=NXfield(freq[1], units='hertz'), radius=NXfield(0.28, **MU_),
-                                          type='contra_rotating_pair', slit_edges=[-sl, sl], transforms=d_ch5)
-    return inst
+    common['mono_chopper'] = NXdisk_chopper(rotation_speed=NXfield(0., units='hertz'), radius=NXfield(0.28, **MU_),
+                                            type='contra_rotating_pair', slit_edges=[-sl, sl], transforms=d_ch5)
+    insts = []
+    for ii in range(len(ei)):
+        inst = NXinstrument(fermi=NXfermi_chopper(energy=ei[ii]))
+        inst['name'] = NXfield(value='LET', short_name='LET')
+        inst['source'] = common['source']
+        inst['moderator'] = common['moderator']
+        inst['horiz_div'] = NXbeam(data=_divergence_nxdata(angh, hprof[ii], 'Horizontal Divergence'))
+        inst['vert_div'] = NXbeam(data=_divergence_nxdata(angv, vprof[ii], 'Vertical Divergence'))
+        for chopper, fq in zip(['shaping_chopper', 'mono_chopper'], freq[ii]):
+            inst[chopper] = common[chopper]
+            inst[chopper]['rotation_speed'] = NXfield(fq, units='hertz')
+        insts.append(inst)
+    return insts
+
+
+def _isis_fermi_instruments(instrument, name, ei, freq, chopper, common, mod_type):
+    # Builds MAPS or MERLIN type instruments for a list of incident energies and Fermi frequencies
+    # from a group of common (Ei-independent) components
+    pulse_signal, pulse_tof = get_moderator_time_pulse(instrument, ei)
+    insts = []
+    for ii in range(len(ei)):
+        inst = NXinstrument(fermi=NXfermi_chopper(energy=ei[ii]))
+        inst['name'] = NXfield(value=name[0], short_name=name[1])
+        # Defines the Fermi chopper
+        fermi = inst['fermi']
+        for k, v in get_fermi_data(instrument, freq[ii], chopper).items():
+            fermi[k] = v
+        inst['aperture'] = common['aperture']
+        inst['source'] = common['source']
+        # Defines the moderator
+        pulse = NXdata(signal=NXfield(pulse_signal[ii], unit='1/microsecond/meV', name='Intensity'),
+                       axes=NXfield(pulse_tof, unit='microsecond', name='Time'))
+        inst['moderator'] = NXmoderator(type=mod_type, temperature=NXfield(300, units='kelvin'),
+                                        pulse_shape=pulse, transforms=common['moderator_transforms'])
+        insts.append(inst)
+    return insts
 
 
 def maps_instrument(ei, freq=None, chopper='S'):
-    if freq is None:
-        freq = 600.
-    inst = NXinstrument(fermi=NXfermi_chopper(energy=ei))
-    inst['name'] = NXfield(value='MAPS', short_name='MAPS')
-    # Defines the Fermi chopper
-    fermi = inst['fermi']
-    for k, v in get_fermi_data('maps', freq, chopper).items():
-        fermi[k] = v
+    return maps_instruments([ei], None if freq is None else [freq], chopper)[0]
+
+
+def maps_instruments(ei, freq=None, chopper='S'):
+    # Builds MAPS instruments for an array of incident energies (and optionally of Fermi frequencies)
+    ei, freq = _as_batch(ei, freq, 600.)
     # Defines the Aperture
     d_ap = NXtransformations(AP_AXIS=NXfield(-10.3290, transformation_type='translation',
                                              vector=[0.,0.,1.], depends_on='.', **MU_))
-    inst['aperture'] = NXslit(x_gap=NXfield(0.0989, **MU_), y_gap=NXfield(0.0989, **MU_),
-                              transforms=d_ap)
+    common = _common_group(aperture=NXslit(x_gap=NXfield(0.0989, **MU_), y_gap=NXfield(0.0989, **MU_),
+                                           transforms=d_ap))
     # Defines the Source
-    inst['source'] = NXsource(Name='ISIS', type='Spallation Neutron Source',
-                              frequency=NXfield(50, units='hertz'), target_material='W')
-    # Defines the moderator
-    d_mod = NXtransformations(MOD_T_AXIS=NXfield(-12., transformation_type='translation',
-                                                 vector=[0.,0.,1.], depends_on='.', **MU_),
-                              MOD_R_AXIS=NXfield(32., transformation_type='rotation',
-                                                 vector=[0.,1.,0.], depends_on='MOD_T_AXIS', units='degree'))
-    pulse_signal, pulse_tof = get_moderator_time_pulse('maps', ei)
-    pulse = NXdata(signal=NXfield(pulse_signal, unit='1/microsecond/meV', name='Intensity'),
-                   axes=NXfield(pulse_tof, unit='microsecond', name='Time'))
-    inst['moderator'] = NXmoderator(type='H20', temperature=NXfield(300, units='kelvin'),
-                                    pulse_shape=pulse, transforms=d_mod)
-    return inst
+    common['source'] = NXsource(Name='ISIS', type='Spallation Neutron Source',
+                                frequency=NXfield(50, units='hertz'), target_material='W')
+    # Defines the moderator position
+    common['moderator_transforms'] = NXtransformations(
+        MOD_T_AXIS=NXfield(-12., transformation_type='translation',
+                           vector=[0.,0.,1.], depends_on='.', **MU_),
+        MOD_R_AXIS=NXfield(32., transformation_type='rotation',
+                           vector=[0.,1.,0.], depends_on='MOD_T_AXIS', units='degree'))
+    return _isis_fermi_instruments('maps', ['MAPS', 'MAPS'], ei, freq, chopper, common, 'H20')
 
 
 def merlin_instrument(ei, freq=None, chopper='G'):
-    if freq is None:
-        freq = 600.
-    inst = NXinstrument(fermi=NXfermi_chopper(energy=ei))
-    inst['name'] = NXfield(value='MERLIN', short_name='MER')
-    # Defines the Fermi chopper
-    inst['name'].replace(NXfield(value='MERLIN', short_name='MER'))
-    inst['fermi'].energy = ei
-    fermi = inst['fermi']
-    for k, v in get_fermi_data('merlin', freq, chopper).items():
-        fermi[k] = v
+    return merlin_instruments([ei], None if freq is None else [freq], chopper)[0]
+
+
+def merlin_instruments(ei, freq=None, chopper='G'):
+    # Builds MERLIN instruments for an array of incident energies (and optionally of Fermi frequencies)
+    ei, freq = _as_batch(ei, freq, 600.)
     # Defines the Aperture
     d_ap = NXtransformations(AP_AXIS=NXfield(-10.1570, transformation_type='translation',
                                              vector=[0.,0.,1.], depends_on='.', **MU_))
-    inst['aperture'] = NXslit(x_gap=NXfield(0.0967, **MU_), y_gap=NXfield(0.0967, **MU_),
-                              transforms=d_ap)
+    common = _common_group(aperture=NXslit(x_gap=NXfield(0.0967, **MU_), y_gap=NXfield(0.0967, **MU_),
+                                           transforms=d_ap))
     # Defines the Source
-    inst['source'] = NXsource(Name='ISIS', type='Spallation Neutron Source',
-                              frequency=NXfield(50, units='hertz'), target_material='W')
-    # Defines the moderator
-    d_mod = NXtransformations(MOD_T_AXIS=NXfield(-11.837, transformation_type='translation',
-                                                 vector=[0.,0.,1.], depends_on='.', **MU_),
-                              MOD_R_AXIS=NXfield(0., transformation_type='rotation',
-                                                 vector=[0.,1.,0.], depends_on='MOD_T_AXIS', units='degree'))
-    pulse_signal, pulse_tof = get_moderator_time_pulse('merlin', ei)
-    pulse = NXdata(signal=NXfield(pulse_signal, unit='1/microsecond/meV', name='Intensity'),
-                   axes=NXfield(pulse_tof, unit='microsecond', name='Time'))
-    inst['moderator'] = NXmoderator(type='H20', temperature=NXfield(300, units='kelvin'),
-                                    pulse_shape=pulse, transforms=d_mod)
-    return inst
-
-
+    common['source'] = NXsource(Name='ISIS', type='Spallation Neutron Source',
+                                frequency=NXfield(50, units='hertz'), target_material='W')
+    # Defines the moderator position
+    common['moderator_transforms'] = NXtransformations(
+        MOD_T_AXIS=NXfield(-11.837, transformation_type='translation',
+                           vector=[0.,0.,1.], depends_on='.', **MU_),
+        MOD_R_AXIS=NXfield(0., transformation_type='rotation',
+                           vector=[0.,1.,0.], depends_on='MOD_T_AXIS', units='degree'))
+    return _isis_fermi_instruments('merlin', ['MERLIN', 'MER'], ei, freq, chopper, common, 'H20')
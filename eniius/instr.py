@@ -0,0 +1,216 @@
+import re
+import os
+
+from .mcstas import McStasCompRecord, McStasInstrRecord
+from .comps import get_component
+
+# Keywords of the TRACE grammar which the native parser does not handle
+UNSUPPORTED_KEYWORDS = ['SPLIT', 'REMOVABLE', 'WHEN', 'GROUP', 'JUMP', 'COPY', 'SEARCH', 'CPU', 'MCDISPLAY']
+
+
+class UnsupportedInstr(RuntimeError):
+    # Raised for constructs in an instr file which the native parser does not handle
+    pass
+
+
+def _enclosed(text):
+    # Returns the text inside the first (top-level) pair of parentheses
+    i0 = text.index('(')
+    return text[(i0 + 1):_closing(text, i0)]
+
+
+def _closing(text, i0):
+    # Index of the parenthesis closing the one at text[i0] (skipping quoted strings)
+    depth, quote = 0, False
+    for ii in range(i0, len(text)):
+        ch = text[ii]
+        if ch == '"' and text[ii - 1] != '\\':
+            quote = not quote
+        elif not quote and ch == '(':
+            depth += 1
+        elif not quote and ch == ')':
+            depth -= 1
+            if depth == 0:
+                return ii
+    raise UnsupportedInstr(f'Unbalanced parentheses in "{text.strip()}"')
+
+
+def _split_top(text):
+    # Splits text at commas which are not within parentheses, braces or quoted strings
+    parts, depth, quote, i0 = [], 0, False, 0
+    for ii, ch in enumerate(text):
+        if ch == '"' and (ii == 0 or text[ii - 1] != '\\'):
+            quote = not quote
+        elif not quote and ch in '({':
+            depth += 1
+        elif not quote and ch in ')}':
+            depth -= 1
+        elif not quote and depth == 0 and ch == ',':
+            parts.append(text[i0:ii])
+            i0 = ii + 1
+    return parts + [text[i0:]]
+
+
+def _sanitize(line, state):
+    # Strips a line and removes comments; state['comment'] tracks block comments spanning lines
+    line = line.strip()
+    out = ''
+    while line:
+        if state['comment']:
+            if '*/' not in line:
+                return out.strip()
+            line = line.split('*/', 1)[1]
+            state['comment'] = False
+        i_line, i_block = line.find('//'), line.find('/*')
+        if i_line >= 0 and (i_block < 0 or i_line < i_block):
+            return (out + line[:i_line]).strip()
+        if i_block < 0:
+            return (out + line).strip()
+        out, line = out + line[:i_block], line[(i_block + 2):]
+        state['comment'] = True
+    return out.strip()
+
+
+def _read_definition(lines, state):
+    # Reads the instrument parameters from the DEFINE INSTRUMENT statement
+    text = None
+    for line in lines:
+        line = _sanitize(line, state)
+        if text is None and line.startswith('DEFINE INSTRUMENT'):
+            text = ''
+        if text is not None:
+            text += ' ' + line
+            if '(' in text and text.count('(') == text.count(')'):
+                break
+    if text is None:
+        raise UnsupportedInstr('No DEFINE INSTRUMENT statement')
+    parameters = {}
+    for par in _split_top(_enclosed(text)):
+        par = par.strip()
+        if not par:
+            continue
+        decl, _, value = [v.strip() for v in par.partition('=')]
+        ptype, name = decl.split(None, 1) if ' ' in decl else ('double', decl)
+        if ptype not in ('double', 'int', 'string'):
+            raise UnsupportedInstr(f'Unsupported instrument parameter "{par}"')
+        if not value:
+            parameters[name] = None
+        elif ptype == 'string':
+            parameters[name] = value
+        else:
+            try:
+                parameters[name] = int(value) if ptype == 'int' else float(value)
+            except ValueError:
+                raise UnsupportedInstr(f'Unsupported default value of instrument parameter "{par}"')
+    return parameters
+
+
+def _read_position(text, keyword):
+    # Parses an AT or ROTATED clause at the start of text; returns (data, relative, rest of text)
+    data = _split_top(_enclosed(text))
+    if len(data) != 3:
+        raise UnsupportedInstr(f'{keyword} must have three coordinates: "{text}"')
+    data[0] = data[0].lstrip()
+    rest = text[(_closing(text, text.index('(')) + 1):].split()
+    if rest[:1] == ['ABSOLUTE']:
+        return data, 'ABSOLUTE', ' '.join(rest[1:])
+    elif rest[:1] == ['RELATIVE'] and len(rest) > 1 and re.fullmatch(r'\w+', rest[1]):
+        return data, f'RELATIVE {rest[1]}', ' '.join(rest[2:])
+    raise UnsupportedInstr(f'Unsupported {keyword} reference in "{text}"')
+
+
+def _read_component(statement, extend):
+    # Parses a COMPONENT statement (with its comments and EXTEND block removed)
+    match = re.match(r'COMPONENT\s+(\w+)\s*=\s*(\w+)\s*\(', statement)
+    if match is None:
+        raise UnsupportedInstr(f'Unsupported statement "{statement}"')
+    name, component_name = match.group(1), match.group(2)
+    i0 = match.end() - 1
+    i1 = _closing(statement, i0)
+    rest = statement[(i1 + 1):].strip()
+    for keyword in UNSUPPORTED_KEYWORDS:
+        if re.search(rf'\b{keyword}\b', rest) or component_name == keyword:
+            raise UnsupportedInstr(f'Keyword {keyword} is not supported: "{statement}"')
+    try:
+        info = get_component(component_name)
+    except NameError as err:
+        raise UnsupportedInstr(str(err))
+    values = {}
+    for par in _split_top(statement[(i0 + 1):i1]):
+        if par.strip():
+            if '=' not in par:
+                raise UnsupportedInstr(f'Unsupported parameter "{par}" of component {name}')
+            values[par.split('=', 1)[0].strip()] = par.split('=', 1)[1].strip()
+    names = info.parameter_names
+    if any([k not in names for k in values]):
+        raise UnsupportedInstr(f'Unknown parameters of component {name}: {set(values) - set(names)}')
+    position = {'AT_data':[0, 0, 0], 'AT_relative':'ABSOLUTE', 'ROTATED_data':[0, 0, 0], 'ROTATED_relative':'ABSOLUTE'}
+    for keyword in ['AT', 'ROTATED']:
+        if re.match(rf'{keyword}\s*\(', rest):
+            position[f'{keyword}_data'], position[f'{keyword}_relative'], rest = _read_position(rest, keyword)
+    if rest:
+        raise UnsupportedInstr(f'Unsupported clause "{rest}" of component {name}')
+    return McStasCompRecord({p:values.get(p, None) for p in names}, name=name, component_name=component_name,
+                            category=info.category, EXTEND=extend, **position)
+
+
+def _read_trace(lines, state):
+    # Yields the components in the TRACE section, parsing each statement when the next one starts
+    statement, extend, in_extend = None, '', False
+    for line in lines:
+        line = _sanitize(line, state)
+        if in_extend:
+            # EXTEND code is kept line by line, escaped as by mcstasscript
+            line = line.split('%{', 1)[-1].strip()
+            if '%}' in line:
+                line, in_extend = line.split('%}', 1)[0].strip(), False
+            if line:
+                extend += line.replace('\\n', '\\\\n').replace('"', '\\"') + '\n'
+            continue
+        if not line:
+            continue
+        if re.match(r'(END|FINALLY)\b', line) or line.startswith(('COMPONENT', '%include', '#include')) \
+                or re.match(r'(SPLIT|REMOVABLE)\b', line):
+            if statement is not None:
+                yield _read_component(statement, extend)
+            statement, extend = None, ''
+            if not line.startswith('COMPONENT'):
+                if re.match(r'(END|FINALLY)\b', line):
+                    return
+                raise UnsupportedInstr(f'Unsupported statement "{line}"')
+        if statement is None and not line.startswith('COMPONENT'):
+            raise UnsupportedInstr(f'Unsupported statement "{line}"')
+        if re.search(r'\bEXTEND\b', line):
+            line, code = line.split('EXTEND', 1)
+            in_extend = True
+            if '%{' in code:
+                code = code.split('%{', 1)[1].strip()
+                if '%}' in code:
+                    code, in_extend = code.split('%}', 1)[0].strip(), False
+                if code:
+                    extend += code.replace('\\n', '\\\\n').replace('"', '\\"') + '\n'
+        statement = line if statement is None else f'{statement} {line}'
+    raise UnsupportedInstr('No END of the TRACE section')
+
+
+def read_instr(instrfile):
+    # Natively parses the subset of the McStas instrument grammar which eniius uses (instrument parameters,
+    # and component names, types, parameters, AT and ROTATED clauses and EXTEND code), reading the file line
+    # by line. Returns a McStasInstrRecord equivalent to that from mcstasscript, or raises UnsupportedInstr
+    # for other constructs (e.g. WHEN, GROUP, JUMP, SPLIT, COPY or %include).
+    state = {'comment': False}
+    with open(instrfile, 'r') as f:
+        parameters = _read_definition(f, state)
+        in_code = False
+        for line in f:
+            line = _sanitize(line, state)
+            if not in_code and line.startswith('TRACE'):
+                break
+            if '%{' in line:
+                in_code = True
+            if '%}' in line:
+                in_code = False
+        else:
+            raise UnsupportedInstr('No TRACE section')
+        components = list(_read_trace(f, state))
+    return McStasInstrRecord(os.path.basename(instrfile).replace('.instr', ''), components, parameters)
@@ -1,6 +1,5 @@
 from nexusformat.nexus import *
 import nexusformat.nexus as nexus
-import mcstasscript
 import numpy as np
 import warnings
 import json
@@ -8,14 +7,19 @@ import copy
 import sys
 import os
 
+from .cache import DiskCache, file_hash
+
 cur_path = os.path.abspath(os.path.join(os.path.dirname(__file__)))
 instr_path = os.path.join(cur_path, 'instruments')
 comps_path = os.path.join(cur_path, 'mcstas-comps')
+INSTR_CACHE = DiskCache('instr', max_size=50*2**20, max_entries=128)
 
 
 def get_instr(instrfile):
+    import mcstasscript  # Deferred as it is slow to import
+    from .comps import new_instr
     instname = os.path.basename(instrfile).replace('.instr', '')
-    inst = mcstasscript.McStas_instr(instname, package_path=comps_path)
+    inst = new_instr(instname)
     if not os.path.exists(instrfile):
         instrfile = os.path.join(instr_path, instrfile)
     reader = mcstasscript.McStas_file(instrfile)
@@ -23,6 +27,72 @@ def get_instr(instrfile):
     return inst
 
 
+def get_instr_record(instrfile, use_cache=True, parser='auto'):
+    # Returns a McStasInstrRecord of an instr file, using a cached copy if the file has been parsed before
+    # parser is 'native' (see instr.read_instr), 'mcstasscript' or 'auto' (native, falling back to mcstasscript
+    # for instr files with constructs which the native parser does not handle)
+    if parser not in ['auto', 'native', 'mcstasscript']:
+        raise RuntimeError(f'Unknown instr parser "{parser}"')
+    if not os.path.exists(instrfile):
+        instrfile = os.path.join(instr_path, instrfile)
+    if use_cache and INSTR_CACHE.enabled:
+        # Records depend on the parser used; those from the native parser (or a fallback from it) also depend
+        # on the native parser source, which decides what it supports
+        native = file_hash(os.path.join(cur_path, 'instr.py')) if parser != 'mcstasscript' else ''
+        key = INSTR_CACHE.key(instrfile, os.path.basename(instrfile), parser, native)
+        record = INSTR_CACHE.load(key)
+        if record is not None:
+            return record
+    record = None
+    if parser != 'mcstasscript':
+        from .instr import read_instr, UnsupportedInstr
+        try:
+            record = read_instr(instrfile)
+        except UnsupportedInstr:
+            if parser == 'native':
+                raise
+    if record is None:
+        record = McStasInstrRecord.from_instr(get_instr(instrfile))
+    if use_cache and INSTR_CACHE.enabled:
+        INSTR_CACHE.save(key, record)
+    return record
+
+
+class McStasCompRecord():
+    # Lightweight copy of the parts of a mcstasscript component used by eniius, which can be pickled
+    # and loaded without importing mcstasscript. Component parameters are stored as attributes.
+    ATTRIBUTES = ['name', 'component_name', 'category', 'AT_data', 'AT_relative',
+                  'ROTATED_data', 'ROTATED_relative', 'EXTEND']
+
+    def __init__(self, parameters, **kwargs):
+        self.parameter_names = list(parameters.keys())
+        for k, v in parameters.items():
+            setattr(self, k, v)
+        for k in self.ATTRIBUTES:
+            setattr(self, k, kwargs[k])
+
+    @classmethod
+    def from_component(cls, comp):
+        return cls({p:getattr(comp, p) for p in comp.parameter_names},
+                   **{k:copy.deepcopy(getattr(comp, k)) for k in cls.ATTRIBUTES})
+
+
+class McStasInstrRecord():
+    # Lightweight copy of a McStas_instr object with its name, parameters and list of components
+    def __init__(self, name, component_list, parameters=None):
+        self.name = name
+        self.component_list = component_list
+        self.parameters = {} if parameters is None else parameters
+
+    @classmethod
+    def from_instr(cls, inst):
+        try:
+            parameters = {k:v.value for k, v in inst.parameters.parameters.items()}
+        except AttributeError:  # Older mcstasscript versions
+            parameters = {}
+        return cls(inst.name, [McStasCompRecord.from_component(cc) for cc in inst.component_list], parameters)
+
+
 def to_float(value):
     try:
         return np.array([float(v) for v in value])
@@ -221,8 +291,16 @@ class McStasComp2NX():
             return cls.COMP2NX_MAP[comp.component_name]
         except KeyError:
             pass
+        category = getattr(comp, 'category', None)
+        if not category:
+            # Components without a category (e.g. built directly) are looked up in the component library index
+            from .comps import get_component
+            try:
+                category = get_component(comp.component_name).category
+            except NameError:
+                pass
         try:
-            return cls.COMPCAT2NX_MAP[comp.category]
+            return cls.COMPCAT2NX_MAP[category]
         except KeyError:
             pass
         nxtype = [v for k,v in cls.COMPGP2NX_MAP.items() if comp.component_name.startswith(k.split('*')[0])]
@@ -324,22 +402,9 @@ class AffineRotate():
         return cls(transform, depends_on)
 
     def axisrot(self):
-        # Computes the net rotation axis and rotation angle from the rotation matrix
-        # https://en.wikipedia.org/wiki/Rotation_matrix#Conversion_from_rotation_matrix_to_axis%E2%80%93angle
-        dd, vv = np.linalg.eig(self.transform[:3, :3])
-        idx = np.where(np.abs(dd - 1) < 1.e-6)[0]
-        assert len(idx) > 0, "Error: Input transformation is not a chained rotation"
-        axis = vv[:, idx[0]]
-        rotmat = self.transform[:3, :3]
-        # Sign of rotation angle is not defined by the expression below (from matrix trace)
-        angle = np.degrees(np.arccos((np.trace(rotmat) - 1.) / 2.))
-        # Checks that the computed axis and angles agree with the original matrix
-        r2 = self.rodrigues(axis, angle)
-        if np.sum(np.abs(rotmat - r2)) > 1.e-5:
-            angle = -angle
-            r2 = self.rodrigues(axis, angle)
-        assert np.sum(np.abs(rotmat - r2)) < 1.e-5, "Error computing the rotation axes and angles"
-        return axis, angle
+        # Computes the net rotation axis and rotation angle from the rotation matrix (see AffineStack.axisrot)
+        axes, angles = AffineStack(self.transform[np.newaxis]).axisrot()
+        return axes[0], angles[0]
 
     @staticmethod
     def rotmat(euler):
@@ -406,6 +471,161 @@ class AffineRotate():
                            transformation_type='rotation', units='degree')
 
 
+class AffineStack():
+    # A batch of N transformations (translation + rotation) held as one contiguous (N, 4, 4) array, with the
+    # AffineRotate operations vectorised over the batch (used for whole-instrument conversions)
+
+    def __init__(self, transforms, depends_on=None):
+        self.transforms = np.ascontiguousarray(transforms).reshape(-1, 4, 4)
+        self.depends_on = ['.'] * len(self.transforms) if depends_on is None else list(depends_on)
+
+    def __len__(self):
+        return self.transforms.shape[0]
+
+    def __getitem__(self, idx):
+        return AffineRotate(self.transforms[idx].copy(), self.depends_on[idx])
+
+    @classmethod
+    def from_affines(cls, affines):
+        return cls(np.array([tr.transform for tr in affines]), [tr.depends_on for tr in affines])
+
+    @classmethod
+    def from_euler_translation(cls, euler_angles, translation_vectors, depends_on=None):
+        euler = np.asarray(euler_angles, dtype=np.float64).reshape(-1, 3)
+        transforms = np.tile(np.eye(4), (len(euler), 1, 1))
+        transforms[:, :3, :3] = cls.rotmat(euler)
+        transforms[:, :3, 3] = translation_vectors
+        return cls(transforms, depends_on)
+
+    @classmethod
+    def from_nxfields(cls, nxfields):
+        # Vectorised AffineRotate.from_nxfield for a list of transformation fields
+        n = len(nxfields)
+        vectors, offsets, values, is_rot = np.zeros((n, 3)), np.zeros((n, 3)), np.zeros(n), np.zeros(n, dtype=bool)
+        depends_on = []
+        for ii, nxfield in enumerate(nxfields):
+            assert hasattr(nxfield, 'transformation_type'), "NXfield must have 'transformation_type' attribute"
+            assert hasattr(nxfield, 'vector'), "NXfield must have 'vector' attribute"
+            depends_on.append(nxfield.depends_on if hasattr(nxfield, 'depends_on') else '.')
+            if hasattr(nxfield, 'offset'):
+                offsets[ii] = to_float(nxfield.offset)
+            if nxfield.transformation_type not in ['translation', 'rotation']:
+                raise RuntimeError('transformation_type must be either "translation" or "rotation"')
+            vectors[ii], values[ii] = to_float(nxfield.vector), nxfield._value
+            is_rot[ii] = nxfield.transformation_type == 'rotation'
+        transforms = np.tile(np.eye(4), (n, 1, 1))
+        transforms[~is_rot, :3, 3] = vectors[~is_rot] * values[~is_rot, np.newaxis] + offsets[~is_rot]
+        transforms[is_rot, :3, :3] = cls.rodrigues(vectors[is_rot], values[is_rot])
+        transforms[is_rot, :3, 3] = offsets[is_rot]
+        return cls(transforms, depends_on)
+
+    @staticmethod
+    def rotmat(euler):
+        # Vectorised AffineRotate.rotmat for (N, 3) Euler angles, returns (N, 3, 3) rotation matrices
+        cc = np.cos(np.radians(euler)).T
+        ss = np.sin(np.radians(euler)).T
+        return np.stack([np.stack([ cc[1]*cc[2], ss[0]*ss[1]*cc[2]+cc[0]*ss[2], ss[0]*ss[2]-cc[0]*ss[1]*cc[2]], -1),
+                         np.stack([-cc[1]*ss[2], cc[0]*cc[2]-ss[0]*ss[1]*ss[2], ss[0]*cc[2]+cc[0]*ss[1]*ss[2]], -1),
+                         np.stack([       ss[1],                  -ss[0]*cc[1],                   cc[0]*cc[1]], -1)], -2)
+
+    @staticmethod
+    def get_euler_angles(rotmat):
+        # Vectorised AffineRotate.get_euler_angles for (N, 3, 3) rotation matrices
+        assert np.all((np.abs(np.linalg.det(rotmat)) - 1) < 1.e-5), "Error: transformation is not valid"
+        return np.stack([np.degrees(np.arctan2(-rotmat[:,2,1], rotmat[:,2,2])),
+                         np.degrees(np.arctan2(rotmat[:,2,0], np.sqrt(1 - rotmat[:,2,0]**2))),
+                         np.degrees(np.arctan2(-rotmat[:,1,0], rotmat[:,0,0]))], -1)
+
+    @staticmethod
+    def rodrigues(axes, angles):
+        # Vectorised AffineRotate.rodrigues for (N, 3) axes and (N,) angles
+        axes = np.asarray(axes).reshape(-1, 3)
+        a = np.radians(np.asarray(angles)).reshape(-1, 1, 1)
+        zero = np.zeros(len(axes), dtype=axes.dtype)
+        kperp = np.stack([np.stack([zero, -axes[:,2], axes[:,1]], -1),
+                          np.stack([axes[:,2], zero, -axes[:,0]], -1),
+                          np.stack([-axes[:,1], axes[:,0], zero], -1)], -2)
+        return np.eye(3)*np.cos(a) + (1 - np.cos(a))*(axes[:,:,np.newaxis] * axes[:,np.newaxis,:]) + np.sin(a)*kperp
+
+    def compose(self, other):
+        # Returns the products self[i] @ other[i] (or self[i] @ other for a single 4x4 matrix), which depend on
+        # what other depends on
+        if isinstance(other, AffineStack):
+            return AffineStack(np.matmul(self.transforms, other.transforms), other.depends_on)
+        return AffineStack(np.matmul(self.transforms, other), self.depends_on)
+
+    def reverse(self, depends_on=None):
+        # Vectorised AffineRotate.reverse
+        transforms = np.tile(np.eye(4), (len(self), 1, 1))
+        transforms[:, :3, :3] = np.transpose(self.transforms[:, :3, :3], (0, 2, 1))
+        transforms[:, :3, 3] = -self.transforms[:, :3, 3]
+        return AffineStack(transforms, self.depends_on if depends_on is None else depends_on)
+
+    @property
+    def is_translation(self):
+        return np.sum(np.abs(self.transforms[:, :3, :3] - np.eye(3)), axis=(1, 2)) < 1.e-5
+
+    def axisrot(self):
+        # Computes the rotation axes and angles (in degrees) from the rotation matrices via their unit quaternions,
+        # returning (N, 3) axes and (N,) angles. Each quaternion is computed from the largest of its components
+        # (Shepperd's method), so it is accurate near 0 and 180 degrees. Angles are in [0, 180] with the axis
+        # giving the sense of rotation; the axis of a null rotation is taken as x.
+        # https://en.wikipedia.org/wiki/Rotation_matrix#Quaternion
+        rr = np.real(self.transforms[:, :3, :3])
+        trace = np.trace(rr, axis1=1, axis2=2)
+        diag = np.diagonal(rr, axis1=1, axis2=2)
+        skew = np.stack([rr[:,2,1] - rr[:,1,2], rr[:,0,2] - rr[:,2,0], rr[:,1,0] - rr[:,0,1]], -1)
+        sym = np.stack([rr[:,0,1] + rr[:,1,0], rr[:,0,2] + rr[:,2,0], rr[:,1,2] + rr[:,2,1]], -1)
+        largest = np.argmax(np.concatenate([trace[:, np.newaxis], diag], axis=1), axis=1)
+        quat = np.zeros((len(self), 4))
+        ii = np.where(largest == 0)[0]
+        quat[ii, 0] = np.sqrt(np.maximum(1 + trace[ii], 0))
+        quat[ii, 1:] = skew[ii] / quat[ii, 0:1]
+        # The symmetric sums are proportional to xy, xz and yz: the other two vector components are from the two
+        # sums with the largest (given as (quaternion index, sum index))
+        for axis, others in enumerate([((2, 0), (3, 1)), ((1, 0), (3, 2)), ((1, 1), (2, 2))]):
+            ii = np.where(largest == axis + 1)[0]
+            qa = np.sqrt(np.maximum(1 + 2 * diag[ii, axis] - trace[ii], 0))
+            quat[ii, axis + 1] = qa
+            quat[ii, 0] = skew[ii, axis] / qa
+            for (iq, isym) in others:
+                quat[ii, iq] = sym[ii, isym] / qa
+        quat *= np.where(quat[:, 0] < 0, -1, 1)[:, np.newaxis]
+        norm = np.linalg.norm(quat[:, 1:], axis=1)
+        angles = np.degrees(2 * np.arctan2(norm, quat[:, 0]))
+        axes = np.tile([1., 0., 0.], (len(self), 1))
+        nonzero = norm > 1.e-12 * np.linalg.norm(quat, axis=1)
+        axes[nonzero] = quat[nonzero, 1:] / norm[nonzero, np.newaxis]
+        assert np.all(np.sum(np.abs(rr - self.rodrigues(axes, angles)), axis=(1, 2)) < 1.e-5), \
+            "Error computing the rotation axes and angles"
+        return axes, angles
+
+    def NXfields(self):
+        # Vectorised AffineRotate.NXfield, returns a list of NXfield objects
+        assert np.abs(np.imag(self.transforms)).sum() < 1e-5, "Error computing transformation vector"
+        transforms = np.real(self.transforms)
+        is_translation = AffineStack(transforms).is_translation
+        vectors = transforms[:, :3, 3].copy()
+        distances = np.linalg.norm(vectors, axis=1)
+        normed = is_translation & (distances > 1e-5)
+        vectors[normed] /= distances[normed, np.newaxis]
+        rotations = np.where(~is_translation)[0]
+        if len(rotations) > 0:
+            axes, angles = AffineStack(transforms[rotations]).axisrot()
+            assert np.abs(np.imag(axes)).sum() < 1e-5, "Error computing rotation from transform"
+            axes = np.real(axes)
+        fields, irot = [], 0
+        for ii in range(len(self)):
+            if is_translation[ii]:
+                fields.append(NXfield(distances[ii], vector=vectors[ii], depends_on=self.depends_on[ii],
+                                      transformation_type='translation', units='metre'))
+            else:
+                fields.append(NXfield(angles[irot], vector=axes[irot], offset=transforms[ii, :3, 3],
+                                      depends_on=self.depends_on[ii], transformation_type='rotation', units='degree'))
+                irot += 1
+        return fields
+
+
 class NXMcStas():
     # Class to convert a McStas instrument definition embodied by a list of components to a NeXus file
 
@@ -421,42 +641,60 @@ class NXMcStas():
             if (relate_at != relate_rot) and (relate_rot != 'ABSOLUTE') and (relate_at != 'ABSOLUTE'):
                 raise RuntimeError('Rotation and position relative to different components not supported')
             if relate_at == 'PREVIOUS' and ii > 0:
-                relate_at = self.component_name_from_index(ii-1)
+                relate_at = self.components[ii-1].name
             if relate_at != 'ABSOLUTE' and relate_at not in self.indices:
                 raise RuntimeError("Components can only be positioned relative to previously defined components")
-                
-            self.transforms[comp.name] = AffineRotate.from_euler_translation(to_float(comp.ROTATED_data),
-                                                                             to_float(comp.AT_data),
-                                                                             depends_on=relate_at)
             self.depends_on[comp.name] = relate_at
             self.components.append(comp)
             self.indices[comp.name] = ii
-        # Map out the RELATIVE chain of transformations and save as list
-        for comp in self.components:
-            node = comp.name
-            self.affinelist[comp.name] = [self.transforms[node]]
-            while self.depends_on[node] != 'ABSOLUTE':
-                node = self.depends_on[node]
-                self.affinelist[comp.name].append(self.transforms[node])
+        # The transformations of all components are computed together as one (N, 4, 4) stack
+        names = [comp.name for comp in self.components]
+        stack = AffineStack.from_euler_translation([to_float(comp.ROTATED_data) for comp in self.components],
+                                                   [to_float(comp.AT_data) for comp in self.components],
+                                                   depends_on=[self.depends_on[name] for name in names])
+        self.transforms = {name:stack[ii] for ii, name in enumerate(names)}
+        # Cumulative transformation (to ABSOLUTE) of each component by pointer jumping: at each step a component's
+        # product so far is multiplied by that of its current ancestor, halving the remaining chain lengths
+        cumulative = stack.transforms.copy()
+        ancestor = np.array([self.indices.get(self.depends_on[name], -1) for name in names], dtype=int)
+        jump = np.where(ancestor >= 0)[0]
+        while len(jump) > 0:
+            cumulative[jump] = np.matmul(cumulative[jump], cumulative[ancestor[jump]])
+            ancestor[jump] = ancestor[ancestor[jump]]
+            jump = jump[ancestor[jump] >= 0]
         # Horace and Mantid sets the origin at the sample position.
         # For compatibility, we define NeXus files with the origin there if possible
         samp = [comp for comp in components_list if comp.category == 'samples']
         if len(samp) == 0:
             warnings.warn("Instrument does not have a sample. Will use the McStas "
-                          "ABSOLUTE positions", warnings.RuntimeWarning)
+                          "ABSOLUTE positions", RuntimeWarning)
             self.origin, rev_trans = ('', [])
         else:
             if len(samp) > 1:
                 warnings.warn("More than one sample in instrument. Will use the first "
-                              "sample position as the origin.", warnings.RuntimeWarning)
+                              "sample position as the origin.", RuntimeWarning)
             self.origin = samp[0].name
-            deps =  [tr.depends_on for tr in self.affinelist[self.origin][::-1]][1:] + ['.']
-            rev_trans = [tr.reverse(depends_on=deps[ii]) for ii, tr in enumerate(self.affinelist[self.origin][::-1])]
-        for name in [comp.name for comp in self.components]:
-            if name == self.origin:
-                self.affinelist[name] = [AffineRotate.from_euler_translation([0, 0, 0], [0, 0, 0])]
-                continue
-            self.affinelist[name] = self._reduce_transforms(self.affinelist[name] + rev_trans)
+            chain = self._transform_chain(self.origin)
+            deps =  [tr.depends_on for tr in chain[::-1]][1:] + ['.']
+            rev_trans = [tr.reverse(depends_on=deps[ii]) for ii, tr in enumerate(chain[::-1])]
+        # The chain of each component followed by the reverse of the sample's reduces to a single transformation
+        if rev_trans:
+            final = AffineStack(cumulative).compose(self._reduce_transforms(rev_trans)[0].transform).transforms
+        else:
+            final = cumulative
+        if self.origin:
+            final[self.indices[self.origin]] = np.eye(4)
+        self._stack = AffineStack(final, ['.' if rev_trans else 'ABSOLUTE'] * len(names))
+        for ii, name in enumerate(names):
+            self.affinelist[name] = [self._stack[ii]]
+
+    def _transform_chain(self, name):
+        # Returns the transformations in the RELATIVE chain from a component back to ABSOLUTE
+        chain = [self.transforms[name]]
+        while self.depends_on[name] != 'ABSOLUTE':
+            name = self.depends_on[name]
+            chain.append(self.transforms[name])
+        return chain
 
     def _reduce_transforms(self, affinelist):
         # Checks if successive transformations could be concatenated
@@ -484,23 +722,33 @@ class NXMcStas():
                 return name
         return None
 
-    def NXtransformations(self, name):
-        # Returns an NXtransformations group for a component with a name
-        transdict = {}
-        for idx, trans in enumerate(self.affinelist[name]):
-            transdict[f'{name}{idx}'] = trans.NXfield()
-        return NXtransformations(**transdict)
-
-    def NXcomponent(self, name, order=0):
+    def _nxfields(self, names):
+        # Returns the transformation fields of a list of components, computed in one batch, as {name: [NXfield]}
+        # (they are computed from the current affinelist each call so changes to it are always reflected)
+        fields = AffineStack.from_affines([tr for n in names for tr in self.affinelist[n]]).NXfields()
+        rv, i0 = {}, 0
+        for n in names:
+            rv[n], i0 = fields[i0:(i0 + len(self.affinelist[n]))], i0 + len(self.affinelist[n])
+        return rv
+
+    def NXtransformations(self, name, fields=None):
+        # Returns an NXtransformations group for a component with a name (fields are its precomputed fields)
+        if fields is None:
+            fields = self._nxfields([name])[name]
+        return NXtransformations(**{f'{name}{idx}':field for idx, field in enumerate(fields)})
+
+    def NXcomponent(self, name, order=0, fields=None):
         # Returns a NXcomponent corresponding to a McStas component.
         comp = self.components[self.indices[name]]
         mcpars = {p:getattr(comp, p) for p in comp.parameter_names}
-        return McStasComp2NX(comp, order, self.NXtransformations(name), **mcpars).nxobj
+        return McStasComp2NX(comp, order, self.NXtransformations(name, fields), **mcpars).nxobj
 
     def NXinstrument(self):
         nxinst = NXinstrument()
+        # The transformation fields of all components are computed in one batch
+        fields = self._nxfields(list(self.indices))
         for order, comp in enumerate(self.components):
-            nxinst[comp.name] = self.NXcomponent(comp.name, order)
+            nxinst[comp.name] = self.NXcomponent(comp.name, order, fields[comp.name])
         return nxinst
 
 
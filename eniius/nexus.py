@@ -1,13 +1,12 @@
 from nexusformat.nexus import *
 import nexusformat.nexus as nexus
-import mcstasscript
 import numpy as np
 import warnings
 import json
 import sys
 import os
 
-from .mcstas import NX2COMP_MAP, AffineRotate, NXoff
+from .mcstas import NX2COMP_MAP, AffineStack, NXoff
 
 comps_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'mcstas-comps'))
 
@@ -28,14 +27,17 @@ class NXinst2McStas():
     # Class to convert a NeXus component to a McStas one
 
     def __init__(self, instname, nx_inst):
+        from .comps import new_instr  # Deferred as mcstasscript is slow to import
         self.instname = instname
-        self.mc_inst = mcstasscript.McStas_instr(self.instname, package_path=comps_path)
+        self.mc_inst = new_instr(self.instname, comps_path)
         self.nx_inst = nx_inst
         self.comps = []
 
+        nxtransforms = {}
         for label, comp in self.nx_inst.items():
             if not hasattr(comp, 'entries'):
                 continue
+            comp_pos = []
             if 'mcstas' in comp.entries:
                 comp_pars, comp_name, comp_ord = self._nx2mc_previous(label, json.loads(comp.mcstas.nxvalue))
             else:
@@ -47,8 +49,11 @@ class NXinst2McStas():
                     continue
             nxtransform = get_nx_component(comp, nxtype=nexus.NXtransformations)
             if nxtransform:  # NXtransformations overwrite parameters defined by component
-                comp_pos = self._get_pos_from_transform(nxtransform)
-            self.comps.append([label, comp_pars, comp_name, comp_pos, comp_ord]) 
+                nxtransforms[len(self.comps)] = nxtransform
+            self.comps.append([label, comp_pars, comp_name, comp_pos, comp_ord])
+        # The positions of all components are computed together
+        for idc, comp_pos in zip(nxtransforms, self._get_pos_from_transforms(list(nxtransforms.values()))):
+            self.comps[idc][3] = comp_pos
         for idc in self._get_order():
             label, comp_pars, comp_name, comp_pos = tuple(self.comps[idc][:4])
             for idx, cp in enumerate(comp_pars):
@@ -84,39 +89,41 @@ class NXinst2McStas():
             rel_name = comp_pos[0][1][1] if (len(comp_pos[0][1]) > 1) else None
         return dist
 
-    def _get_affinelist_from_transform(self, nxtransform):
+    def _get_transform_chain(self, nxtransform):
+        # Orders the fields of an NXtransformations group on the "depends_on" keyword
+        # Returns the ordered field names (from the first applied) and the node the chain depends on
         dep_dict = {v.depends_on:k for k, v in nxtransform.entries.items()}
-        # Construct chain on the "depends_on" keyword.
         init_node = [k for k,v in dep_dict.items() if k == '.' or k not in nxtransform]
         # Prefer absolute, other use a node which is outside this set of transformations
         init_node = '.' if '.' in init_node else init_node[0]
         order = [dep_dict[init_node]]
         while order[-1] in dep_dict:
             order.append(dep_dict[order[-1]])
-        transform = np.eye(4)
-        transform_list, transform_added, dep = ([], False, init_node)
-        for name in order:
-            transform = np.matmul(AffineRotate.from_nxfield(nxtransform[name]).transform, transform)
-            try:
-                tr = AffineRotate(transformation_matrix=transform, depends_on=dep)
-                transform_added = False
-            except AssertionError:
-                transform_list.append(tr)
-                transform_added = True
-                dep = nxtransform[name].depends_on
-        if not transform_added:
-            transform_list.append(tr)
-        return transform_list
-
-    def _get_pos_from_transform(self, nxtransform):
-        transform_list = self._get_affinelist_from_transform(nxtransform)
-        if len(transform_list) > 1:
-            raise NotImplementedError("TODO: implement multiple ARMs for complex transformations")
-        tr = transform_list[0]
-        relative = tr.depends_on if tr.depends_on != '.' else None
-        comp_pos = [['set_AT', [list(tr.transform[:3, 3]), relative]]]
-        if tr.is_rotation:
-            comp_pos.append(['set_ROTATED', [list(AffineRotate.get_euler_angles(tr.transform[:3, :3])), relative]])
+        return order, init_node
+
+    def _get_pos_from_transforms(self, nxtransforms):
+        # Computes the McStas AT and ROTATED positions of a list of NXtransformations groups in one batch: the
+        # chains of all groups are padded with identities to a common length and multiplied as a (N, L, 4, 4) stack
+        if len(nxtransforms) == 0:
+            return []
+        chains = [self._get_transform_chain(nxtransform) for nxtransform in nxtransforms]
+        nlinks = [len(order) for order, _ in chains]
+        fields = AffineStack.from_nxfields([nxtr[name] for nxtr, (order, _) in zip(nxtransforms, chains)
+                                            for name in order])
+        links = np.tile(np.eye(4), (len(chains), max(nlinks), 1, 1))
+        links[np.repeat(np.arange(len(chains)), nlinks), np.concatenate([np.arange(n) for n in nlinks])] = \
+            fields.transforms
+        transforms = links[:, 0]
+        for ii in range(1, links.shape[1]):
+            transforms = np.matmul(links[:, ii], transforms)
+        is_rotation = ~AffineStack(transforms).is_translation
+        euler = AffineStack.get_euler_angles(transforms[:, :3, :3])
+        comp_pos = []
+        for ii, (_, init_node) in enumerate(chains):
+            relative = init_node if init_node != '.' else None
+            comp_pos.append([['set_AT', [list(transforms[ii, :3, 3]), relative]]])
+            if is_rotation[ii]:
+                comp_pos[-1].append(['set_ROTATED', [list(euler[ii]), relative]])
         return comp_pos
 
     def _nx2mc_previous(self, label, compdict):
@@ -0,0 +1,111 @@
+import numpy as np
+import itertools
+
+# Number of values per line and width of each value in the legacy ASCII .spe format
+SPE_NCOL = 8
+SPE_WIDTH = 10
+# Default number of bytes of data (signal) in each block of detectors read or written at a time
+BLOCK_BYTES = 2**20
+
+
+def _nlines(n):
+    return (n + SPE_NCOL - 1) // SPE_NCOL
+
+
+def _parse_values(lines, n):
+    # Parses n fixed width values (which may not be separated by spaces) from a list of lines
+    # Values are right-justified so trailing whitespace on a line is not part of any value
+    txt = ''.join([l.rstrip() for l in lines])
+    if len(txt) != n * SPE_WIDTH:
+        # Values which are not of the standard width must be separated by spaces
+        values = ' '.join(lines).split()
+        if len(values) != n:
+            raise RuntimeError('Unexpected number of values in SPE file')
+        return np.array(values, dtype=np.float64)
+    return np.frombuffer(txt.encode(), dtype=f'S{SPE_WIDTH}').astype(np.float64)
+
+
+def _read_block(f, n, header):
+    line = f.readline()
+    if not line.startswith(header):
+        raise RuntimeError(f'Expected "{header}" in SPE file, got "{line.strip()}"')
+    return _parse_values(list(itertools.islice(f, _nlines(n))), n)
+
+
+def read_spe_header(f):
+    # Reads the header of an .spe file (from an open file object)
+    # Returns the number of detectors, number of energy bins, the phi grid and the energy bin boundaries
+    ndet, nen = [int(v) for v in f.readline().split()[:2]]
+    phi = _read_block(f, ndet + 1, '### Phi Grid')
+    energy = _read_block(f, nen + 1, '### Energy Grid')
+    return ndet, nen, phi, energy
+
+
+def iter_spe(filename, block_size=None):
+    # Reads the signal and errors of an .spe file in blocks of detectors (rows)
+    # Yields (signal, error) arrays of shape (n_block, n_energy)
+    with open(filename, 'r') as f:
+        ndet, nen, _, _ = read_spe_header(f)
+        nblock = max(1, BLOCK_BYTES // (nen * 8)) if block_size is None else block_size
+        nl = _nlines(nen)
+        for i0 in range(0, ndet, nblock):
+            nrows = min(nblock, ndet - i0)
+            lines = list(itertools.islice(f, nrows * 2 * (nl + 1)))
+            if len(lines) < nrows * 2 * (nl + 1):
+                raise RuntimeError('Unexpected end of data in SPE file')
+            headers = lines[::(nl + 1)]
+            if not (all([l.startswith('### S(Phi,w)') for l in headers[::2]]) and
+                    all([l.startswith('### Errors') for l in headers[1::2]])):
+                raise RuntimeError('Malformed SPE file: expected "### S(Phi,w)" and "### Errors" headers')
+            # Each section is nen fixed width values so all the data lines in the block are parsed at once
+            del lines[::(nl + 1)]
+            values = _parse_values(lines, nrows * 2 * nen).reshape(nrows, 2, nen)
+            yield values[:,0,:], values[:,1,:]
+
+
+class NXSPEData:
+    # A source of NXSPE data which is written to file in blocks of detectors (rows), so that the full
+    # signal and error arrays never need to be held in memory. blocks is an iterable (e.g. a generator)
+    # or a function returning one, of (signal, error) blocks of consecutive rows of shape (n_rows, nen).
+    # energy is the energy bin boundaries (or centres); detector fields (e.g. polar, azimuthal, polar_width,
+    # azimuthal_width, distance) are optional arrays of length ndet written to the NXSPE data group.
+
+    def __init__(self, ndet, nen, energy, blocks, dtype=np.float64, **detector_fields):
+        self.ndet = ndet
+        self.nen = nen
+        self.energy = np.asarray(energy)
+        self.blocks = blocks
+        self.dtype = np.dtype(dtype)
+        self.detector_fields = detector_fields
+
+
+    @classmethod
+    def from_spe(cls, filename, block_size=None, **detector_fields):
+        with open(filename, 'r') as f:
+            ndet, nen, _, energy = read_spe_header(f)
+        return cls(ndet, nen, energy, lambda: iter_spe(filename, block_size), **detector_fields)
+
+
+    @classmethod
+    def from_arrays(cls, signal, error, energy, block_size=None, **detector_fields):
+        # Signal and error can be (read-only) memmaps, of which only a block of rows is read at a time
+        if signal.shape != error.shape:
+            raise RuntimeError('Signal and error arrays must have the same shape')
+        ndet, nen = signal.shape
+        nblock = max(1, BLOCK_BYTES // (nen * signal.dtype.itemsize)) if block_size is None else block_size
+        blocks = lambda: ((signal[i0:(i0 + nblock)], error[i0:(i0 + nblock)]) for i0 in range(0, ndet, nblock))
+        return cls(ndet, nen, energy, blocks, signal.dtype, **detector_fields)
+
+
+    def iter_blocks(self):
+        return self.blocks() if callable(self.blocks) else iter(self.blocks)
+
+
+class NXSPEReference:
+    # NXSPE data in datasets of other HDF5 files, which are referenced as virtual datasets (or by external
+    # links if link=True) rather than copied into the NXSPE file. data, error, energy and the detector fields
+    # are each either a (filename, dataset_path) tuple or an array (which is written to the file)
+
+    def __init__(self, data, error, energy, link=False, **detector_fields):
+        self.fields = {'data':data, 'error':error, 'energy':energy, **detector_fields}
+        self.link = link
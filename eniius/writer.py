@@ -2,30 +2,156 @@ import numpy as np
 import nexusformat.nexus
 import warnings
 import json
+import h5py
+import os
+import threading
+import contextlib
+import concurrent.futures
+from concurrent.futures import _base
+
+from .cache import DiskCache, file_hash
+from .spe import NXSPEData, NXSPEReference, BLOCK_BYTES
+import hashlib
 
 VERSION = '0.1'
+DET_CACHE = DiskCache('detector', max_size=1024*2**20, max_entries=32)
+
+_writegroup = nexusformat.nexus.tree.NXFile._writegroup
+_writedata = nexusformat.nexus.tree.NXFile._writedata
+_ibex_lock = threading.Lock()
+_ibex_state = threading.local()
+_ibex_users = 0
+# nexusformat is not thread-safe, so writes through it (the 'nexus' backend) are made one at a time
+_nexus_lock = threading.Lock()
+
+
+def fixed_ascii(value):
+    # Converts a string (or array of strings) to fixed-width bytes, with scalars as 1-element arrays
+    value = np.asarray(value)
+    if value.dtype.kind != 'S':
+        try:
+            value = value.astype('S')
+        except UnicodeEncodeError:
+            value = np.char.encode(value.astype('U'), 'utf-8')
+    return value.reshape(1) if value.ndim == 0 else value
 
-# Monkey patch the nexus write function to use fixed-width ASCII NX_class labels
-# because IBEX [ISISICP] only supports this format (as it uses the old napi.c)
-old_wg = nexusformat.nexus.tree.NXFile._writegroup
-old_wd = nexusformat.nexus.tree.NXFile._writedata
-def new_wg(self, group):
-    links = old_wg(self, group)
-    if group.nxpath != '' and group.nxpath != '/':
-        path = self.nxpath + '/' + group.nxname
+
+def _ibex_writegroup(self, group):
+    links = _writegroup(self, group)
+    if getattr(_ibex_state, 'depth', 0) and group.nxpath != '' and group.nxpath != '/':
         if group.nxclass and group.nxclass != 'NXgroup':
-            self[path].attrs['NX_class'] = np.array(group.nxclass, dtype='S')
+            self[self.nxpath + '/' + group.nxname].attrs['NX_class'] = np.array(group.nxclass, dtype='S')
     return links
-def new_wd(self, data):
-    if data._target is None and data._uncopied_data is None and data._memfile is None \
-            and (not data.nxfile or data.nxfile.filename == self.filename) \
+
+
+def _ibex_writedata(self, data):
+    if getattr(_ibex_state, 'depth', 0) and data._target is None and data._uncopied_data is None \
+            and data._memfile is None and (not data.nxfile or data.nxfile.filename == self.filename) \
             and data.dtype is not None and data.is_string():
-        data._shape = (1,)
-        data._dtype = f'S{len(data._value)}'
-        data._value = np.array(data._value, dtype='S')
-    return old_wd(self, data)
-nexusformat.nexus.tree.NXFile._writegroup = new_wg
-nexusformat.nexus.tree.NXFile._writedata = new_wd
+        data._value = fixed_ascii(data._value)
+        data._shape, data._dtype = data._value.shape, data._value.dtype
+    return _writedata(self, data)
+
+
+@contextlib.contextmanager
+def ibex_strings():
+    # Within this context, nexusformat writes (in this thread) use fixed-width ASCII NX_class labels and string
+    # fields, because IBEX [ISISICP] only supports this format (as it uses the old napi.c). The NXFile write
+    # methods are only patched while an eniius write is in progress, and only change writes made inside it.
+    global _ibex_users
+    with _ibex_lock:
+        if _ibex_users == 0:
+            nexusformat.nexus.tree.NXFile._writegroup = _ibex_writegroup
+            nexusformat.nexus.tree.NXFile._writedata = _ibex_writedata
+        _ibex_users += 1
+    depth = getattr(_ibex_state, 'depth', 0)
+    _ibex_state.depth = depth + 1
+    try:
+        yield
+    finally:
+        _ibex_state.depth = depth
+        with _ibex_lock:
+            _ibex_users -= 1
+            if _ibex_users == 0:
+                nexusformat.nexus.tree.NXFile._writegroup = _writegroup
+                nexusformat.nexus.tree.NXFile._writedata = _writedata
+
+
+_export_state = threading.local()
+
+
+class ExportFuture(concurrent.futures.Future):
+    # The future of a background export (see Eniius.submit). progress is an optional function, called in the
+    # worker thread as progress(stage, fraction) while the file is written. cancel() also cancels an export which
+    # is already running: the future is cancelled at once (waiters and callbacks are notified as for a pending
+    # future) and the worker stops at its next progress point without moving its output into place.
+
+    def __init__(self, progress=None):
+        super().__init__()
+        self.stage, self.fraction = 'queued', 0.
+        self._progress = progress
+        self._stop = threading.Event()
+        self._finishing = False
+
+    def cancel(self):
+        # Future.cancel only cancels pending futures; a running export is cancelled here in the same way as
+        # Future.cancel and set_running_or_notify_cancel do (using the Future internals, which test_submit_export
+        # checks against concurrent.futures.wait and as_completed)
+        if super().cancel():
+            return True
+        with self._condition:
+            if self._state != _base.RUNNING or self._finishing:
+                return False
+            self._state = _base.CANCELLED_AND_NOTIFIED
+            for waiter in self._waiters:
+                waiter.add_cancelled(self)
+            self._condition.notify_all()
+        self._stop.set()
+        self._invoke_callbacks()
+        return True
+
+    def finish(self, tmpfile, filename, err=None):
+        # Called by the worker when the export ends: moves the output written to tmpfile to filename and sets
+        # the result (or sets the exception err), unless the export was cancelled first
+        with self._condition:
+            if self.cancelled():
+                return False
+            self._finishing = True
+            if err is None:
+                try:
+                    os.replace(tmpfile, filename)
+                except OSError as replace_err:
+                    err = replace_err
+        if err is None:
+            self.set_result(filename)
+        else:
+            self.set_exception(err)
+        return True
+
+    def report(self, stage, fraction):
+        if self._stop.is_set():
+            raise concurrent.futures.CancelledError(f'Export cancelled during {stage}')
+        self.stage, self.fraction = stage, fraction
+        if self._progress is not None:
+            self._progress(stage, fraction)
+
+
+@contextlib.contextmanager
+def export_progress(future):
+    # Within this context, progress of writes (in this thread) is reported to the given ExportFuture
+    previous = getattr(_export_state, 'future', None)
+    _export_state.future = future
+    try:
+        yield future
+    finally:
+        _export_state.future = previous
+
+
+def report_progress(stage, fraction):
+    # Reports progress to the current background export (if any); raises CancelledError if it was cancelled
+    future = getattr(_export_state, 'future', None)
+    if future is not None:
+        future.report(stage, fraction)
 
 from nexusformat.nexus import *
 
@@ -63,6 +189,283 @@ def conv_types(obj):
     return tp, vl
 
 
+def _json_attrs(obj):
+    # Returns the list of JSON attribute entries of a NeXus object
+    attrs = [] if obj.nxclass == 'NXfield' else [{'name':'NX_class', 'dtype':'string', 'values':obj.nxclass}]
+    for n, v in obj.attrs.items():
+        typ, val = conv_types(v)
+        attrs.append({'name':n, 'dtype':typ, 'values':val})
+    return attrs
+
+
+def _json_separators(indent):
+    return (',', ': ') if indent is not None else (',', ':')
+
+
+class JSONStreamWriter:
+    # Writes the same JSON as Writer.to_json incrementally to a file, walking the tree iteratively
+    # and writing numerical arrays in chunks, so the full nested dictionary is never held in memory
+
+    CHUNK = 65536
+
+    def __init__(self, fileobj, indent=4):
+        self.f = fileobj
+        self.indent = indent
+        self.sep = _json_separators(indent)
+
+    def _nl(self, level):
+        return '' if self.indent is None else '\n' + ' ' * (self.indent * level)
+
+    def _dumps(self, obj, level):
+        txt = json.dumps(obj, indent=self.indent, separators=self.sep)
+        return txt if self.indent is None else txt.replace('\n', self._nl(level))
+
+    def _key(self, key, level, first=False):
+        self.f.write(('' if first else self.sep[0]) + self._nl(level) + json.dumps(key) + self.sep[1])
+
+    def _write_values(self, val, level):
+        if not isinstance(val, np.ndarray) or val.ndim == 0 or val.size == 0 or val.dtype.kind not in 'biuf':
+            self.f.write(self._dumps(conv_types(val)[1], level))
+        elif val.ndim > 1:
+            self.f.write('[')
+            for ii in range(val.shape[0]):
+                self.f.write(('' if ii == 0 else self.sep[0]) + self._nl(level + 1))
+                self._write_values(val[ii], level + 1)
+            self.f.write(self._nl(level) + ']')
+        else:
+            self.f.write('[')
+            for i0 in range(0, val.shape[0], self.CHUNK):
+                txt = json.dumps(val[i0:(i0 + self.CHUNK)].tolist(), indent=self.indent, separators=self.sep)[1:-1]
+                if self.indent is not None:
+                    txt = txt.replace('\n', self._nl(level))[:-len(self._nl(level))]
+                self.f.write(('' if i0 == 0 else self.sep[0]) + txt)
+            self.f.write(self._nl(level) + ']')
+
+    def _write_field(self, name, obj, level):
+        val = obj.nxdata
+        typ = conv_types(val.reshape(-1)[:1])[0] if isinstance(val, np.ndarray) and val.size > 0 else conv_types(val)[0]
+        self.f.write('{')
+        self._key('module', level + 1, first=True)
+        self.f.write(json.dumps('dataset'))
+        self._key('config', level + 1)
+        self.f.write('{')
+        self._key('name', level + 2, first=True)
+        self.f.write(json.dumps(name))
+        self._key('values', level + 2)
+        self._write_values(val, level + 2)
+        self._key('type', level + 2)
+        self.f.write(json.dumps(typ) + self._nl(level + 1) + '}')
+        self._write_attrs(obj, level)
+
+    def _write_attrs(self, obj, level):
+        attrs = _json_attrs(obj)
+        if len(attrs) > 0:
+            self._key('attributes', level + 1)
+            self.f.write(self._dumps(attrs, level + 1))
+        self.f.write(self._nl(level) + '}')
+
+    def write(self, nxobj):
+        self.f.write('{')
+        self._key('children', 1, first=True)
+        self.f.write('[')
+        # Each stack frame is (iterator over group items, level of items, number written, group object)
+        stack = [(iter(nxobj.items()), 2, [0], None)]
+        while stack:
+            items, level, count, group = stack[-1]
+            try:
+                k, obj = next(items)
+            except StopIteration:
+                stack.pop()
+                self.f.write((self._nl(level - 1) if count[0] > 0 else '') + ']')
+                if group is not None:
+                    self._write_attrs(group, level - 2)
+                continue
+            if not hasattr(obj, 'nxclass'):
+                raise RuntimeError(f'unrecognised object key {k}')
+            self.f.write(('' if count[0] == 0 else self.sep[0]) + self._nl(level))
+            count[0] += 1
+            if obj.nxclass == 'NXfield':
+                self._write_field(k, obj, level)
+                continue
+            self.f.write('{')
+            self._key('name', level + 1, first=True)
+            self.f.write(json.dumps(k))
+            self._key('type', level + 1)
+            self.f.write(json.dumps('group'))
+            if len(obj._entries) > 0:
+                self._key('children', level + 1)
+                self.f.write('[')
+                stack.append((iter(obj.items()), level + 2, [0], obj))
+            else:
+                self._write_attrs(obj, level)
+        self.f.write(self._nl(0) + '}')
+
+
+def _h5opts(shape):
+    # Default dataset storage options, as used by nexusformat (chunked and compressed above a threshold size)
+    size = int(np.prod(shape))
+    if size > nexusformat.nexus.tree.NX_CONFIG['maxsize']:
+        return {'chunks':True, 'compression':nexusformat.nexus.tree.NX_CONFIG['compression'], 'shuffle':True}
+    return {}
+
+
+# Storage of NXSPE datasets: fields in the data group not listed here, and the physical detector tables, are
+# of class 'detector'. Datasets smaller than NXSPE_COMPRESS_MIN bytes are stored contiguous and uncompressed
+NXSPE_CLASSES = {'data':'data', 'error':'data', 'errors':'data', 'energy':'energy'}
+NXSPE_STORAGE_CLASSES = ['data', 'energy', 'detector']
+NXSPE_CHUNK_BYTES = 2**20
+NXSPE_COMPRESS_MIN = 2**16
+
+
+def _class_storage(storage, dataset_class):
+    # Returns the storage of a dataset class from a storage argument which may be keyed by dataset class
+    if isinstance(storage, dict) and len(storage) > 0 and set(storage.keys()) <= set(NXSPE_STORAGE_CLASSES):
+        return storage.get(dataset_class, 'auto')
+    elif isinstance(storage, dict) and set(storage.keys()) & set(NXSPE_STORAGE_CLASSES):
+        raise RuntimeError(f'storage cannot mix dataset classes {NXSPE_STORAGE_CLASSES} and h5py options')
+    return storage
+
+
+def nxspe_h5opts(shape, dtype, dataset_class, storage='auto'):
+    # Returns the h5py dataset options for a dataset of an NXSPE file. storage is either 'auto', None (contiguous,
+    # uncompressed), a compression filter name ('gzip', 'lzf'), a dict of h5py options (e.g. compression,
+    # compression_opts, shuffle, chunks; an empty dict is contiguous and uncompressed) or a dict keyed only by dataset
+    # class ('data', 'energy', 'detector') of any of these (classes not given are 'auto')
+    storage = _class_storage(storage, dataset_class)
+    dtype = np.dtype(dtype)
+    if storage is None or storage == {} or len(shape) == 0 or np.prod(shape) == 0 or dtype.kind in 'OSU':
+        return {}
+    if isinstance(storage, str) and storage == 'auto':
+        if np.prod(shape) * dtype.itemsize < NXSPE_COMPRESS_MIN:
+            return {}
+        storage = {'compression':'gzip', 'compression_opts':4, 'shuffle':True}
+    elif isinstance(storage, str):
+        if storage not in ['gzip', 'lzf']:
+            raise RuntimeError(f'Unknown compression filter "{storage}"')
+        storage = {'compression':storage, 'shuffle':True}
+    opts = dict(storage)
+    if 'chunks' not in opts:
+        # Chunks contain whole rows (all energies for a set of detectors), as Horace reads files by detector
+        row_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+        nrows = int(min(shape[0], max(1, NXSPE_CHUNK_BYTES // row_bytes)))
+        opts['chunks'] = (nrows,) + tuple(shape[1:])
+    return opts
+
+
+def h5_group(parent, name, nxclass):
+    # Creates an HDF5 group with a fixed-width ASCII NX_class attribute (as required by ISISICP)
+    group = parent.create_group(name)
+    if nxclass and nxclass != 'NXgroup':
+        group.attrs['NX_class'] = np.array(nxclass, dtype='S')
+    return group
+
+
+def h5_field(parent, name, value, attrs=None, h5opts=None):
+    # Writes a dataset with strings stored as fixed-width ASCII (as required by ISISICP)
+    value = np.asarray(value)
+    if value.dtype.kind in 'OSU':
+        value = fixed_ascii(value)
+    dset = parent.create_dataset(name, data=value, **(_h5opts(value.shape) if h5opts is None else h5opts))
+    for k, v in ({} if attrs is None else attrs).items():
+        if v is not None:
+            dset.attrs[k] = v
+    return dset
+
+
+def h5_copy_field(parent, name, nxfield, attrs=None, h5opts=None):
+    # Writes a (numerical) field in blocks of rows, so that a field in a file is never read into memory at once
+    dset = parent.create_dataset(name, shape=nxfield.shape, dtype=nxfield.dtype, **({} if h5opts is None else h5opts))
+    nrows = max(1, BLOCK_BYTES // (int(np.prod(nxfield.shape[1:])) * np.dtype(nxfield.dtype).itemsize))
+    for i0 in range(0, nxfield.shape[0], nrows):
+        dset[i0:(i0 + nrows)] = np.asarray(nxfield[i0:(i0 + nrows)].nxdata, dtype=nxfield.dtype)
+    for k, v in ({} if attrs is None else attrs).items():
+        if v is not None:
+            dset.attrs[k] = v
+    return dset
+
+
+def h5_write(h5group, nxgroup, links=None, h5opts=None):
+    # Writes the attributes and children of a NeXus group directly to an HDF5 group (without nexusformat)
+    # Internal links are collected (as path, target, soft) and only created once the whole tree is written
+    # h5opts is an optional function (name, field) -> h5py dataset options (otherwise those of each field)
+    is_top, links = (links is None), ([] if links is None else links)
+    for k, v in nxgroup.attrs.items():
+        if v.nxdata is not None:
+            h5group.attrs[k] = v.nxdata
+    for name, obj in nxgroup.items():
+        if isinstance(obj, NXlink):
+            if obj._filename is not None:
+                h5group[name] = h5py.ExternalLink(obj._filename, obj._target)
+            else:
+                links.append((f'{h5group.name}/{name}', obj._target, obj._soft))
+        elif obj.nxclass == 'NXfield':
+            if obj.dtype is not None:
+                if h5opts is None:
+                    opts = {k:v for k, v in obj._h5opts.items() if k != 'maxshape' or v is not None}
+                else:
+                    opts = h5opts(name, obj)
+                attrs = {k:v.nxdata for k, v in obj.attrs.items()}
+                if obj.is_string() or len(obj.shape) == 0 or np.prod(obj.shape) * obj.dtype.itemsize <= BLOCK_BYTES:
+                    value = obj.nxdata if obj.is_string() else np.asarray(obj.nxdata, dtype=obj.dtype)
+                    h5_field(h5group, name, value, attrs, opts)
+                else:
+                    h5_copy_field(h5group, name, obj, attrs, opts)
+        else:
+            h5_write(h5_group(h5group, name, obj.nxclass), obj, links, h5opts)
+    if is_top:
+        root = h5group.file
+        for path, target, soft in links:
+            if path != target and path not in root and target in root:
+                if soft:
+                    root[path] = h5py.SoftLink(target)
+                else:
+                    if 'target' not in root[target].attrs:
+                        root[target].attrs['target'] = target
+                    root[path] = root[target]
+    return links
+
+
+def nx_checksum(nxobj, hsh=None):
+    # Returns a checksum of the names, classes, attributes and values of a NeXus tree
+    top, hsh = (hsh is None), (hashlib.sha256() if hsh is None else hsh)
+    hsh.update(f'{nxobj.nxname}:{nxobj.nxclass}'.encode())
+    for k, v in sorted(nxobj.attrs.items()):
+        hsh.update(f'@{k}={v.nxdata!r}'.encode())
+    if nxobj.nxclass == 'NXfield':
+        value = np.asarray(nxobj.nxdata)
+        hsh.update(f'{value.dtype}{value.shape}'.encode())
+        hsh.update(value.tobytes() if value.dtype.kind != 'O' else repr(value.tolist()).encode())
+    elif not isinstance(nxobj, NXlink):
+        for k in sorted(nxobj.keys()):
+            nx_checksum(nxobj[k], hsh)
+    return hsh.hexdigest() if top else hsh
+
+
+def _relative_path(h5file, filename):
+    # Path of a file relative to an HDF5 file linking to it (HDF5 looks for external and virtual dataset source
+    # files in the linking file's folder if they are not found otherwise, so the files can be moved together)
+    return os.path.relpath(os.path.abspath(filename), os.path.dirname(os.path.abspath(h5file.filename)))
+
+
+def h5_reference(parent, name, filename, path, link=False):
+    # References a dataset in another HDF5 file as a virtual dataset (or an external link if link=True)
+    # rather than copying it. Scalar and string datasets (which cannot be virtual) are copied.
+    relpath = _relative_path(parent.file, filename)
+    if link:
+        parent[name] = h5py.ExternalLink(relpath, path)
+        return
+    with h5py.File(filename, 'r') as src:
+        dset = src[path]
+        if dset.ndim == 0 or dset.dtype.kind in 'OSU':
+            src.copy(dset, parent, name=name)
+            return
+        layout = h5py.VirtualLayout(shape=dset.shape, dtype=dset.dtype)
+        layout[...] = h5py.VirtualSource(relpath, path, shape=dset.shape)
+        vds = parent.create_virtual_dataset(name, layout)
+        for k, v in dset.attrs.items():
+            vds.attrs[k] = v
+
+
 class Writer:
     """
     Writes out files in various formats from a NeXus structure with instrument information
@@ -70,6 +473,7 @@ class Writer:
 
     def __init__(self, nxobj):
         self.rootname = 'root'
+        self._det = {}
         self.data = None
         self.sample = None
         self.nxobj = None
@@ -100,9 +504,30 @@ class Writer:
             self.nxobj[self.rootname] = nxentry
 
 
-    def to_json(self, invar):
+    def to_json(self, invar, stream=False, indent=4):
         # Converts a NeXus object to a JSON-compatible dictionary
+        # If stream is True (and invar is a filename) the JSON is written incrementally to the file
+        # If indent is None, the JSON is written in compact form without whitespace
+        # The output file is only created (or replaced) once the JSON has been built without errors; the
+        # streamed JSON is written to a temporary file which is renamed on success
         outfile, nxobj = (invar, self.nxobj) if isinstance(invar, str) else (None, invar)
+        if outfile is not None:
+            if not outfile.endswith('.json'):
+                outfile += '.json'
+            if not stream:
+                text = self.json_text(indent)
+                with open(outfile, 'w') as f:
+                    f.write(text)
+                return
+            tmpfile = f'{outfile}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmpfile, 'w') as f:
+                    JSONStreamWriter(f, indent).write(nxobj)
+                os.replace(tmpfile, outfile)
+            finally:
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+            return
         children = []
         for k, obj in nxobj.items():
             if hasattr(obj, 'nxclass'):
@@ -110,93 +535,388 @@ class Writer:
                     typ, val = conv_types(obj.nxdata)
                     entry = {'module':'dataset',
                              'config':{'name':k, 'values':val, 'type':typ}}
-                    attrs = []
                 else:
                     entry = {'name':k, 'type':'group'}
-                    attrs = [{'name':'NX_class', 'dtype':'string', 'values':obj.nxclass}]
                     if len(obj._entries) > 0:
                         entry['children'] = self.to_json(obj)
             else:
                 raise RuntimeError(f'unrecognised object key {k}')
-            for n, v in obj.attrs.items():
-                typ, val = conv_types(v)
-                attrs.append({'name':n, 'dtype':typ, 'values':val})
+            attrs = _json_attrs(obj)
             if len(attrs) > 0:
                 entry['attributes'] = attrs
             children.append(entry)
-        if outfile is not None:
-            if not outfile.endswith('.json'):
-                outfile += '.json'
-            with open(outfile, 'w') as f:
-                f.write(json.dumps({'children':children}, indent=4))
-        else:
-            return children
+        return children
 
 
-    def to_nxspe(self, outfile, ei=25, det_file=None):
+    def json_text(self, indent=4):
+        # Returns the JSON representation of the whole NeXus tree as a string
+        return json.dumps({'children':self.to_json(self.nxobj)}, indent=indent, separators=_json_separators(indent))
+
+
+    def to_nxspe(self, outfile, ei=25, det_file=None, backend=None, storage='auto', template=None, link=False,
+                 data=None):
+        # data is an optional NXSPEData source or the name of an .spe file, which is written in blocks
+        # of detectors (bounding the memory used), or an NXSPEReference to datasets in other HDF5 files;
+        # otherwise the NXdata in the input (or a placeholder) is used. If det_file is an HDF5 file
+        # (e.g. an earlier output) its detector tables are referenced as virtual datasets
+        # backend='h5py' writes the file directly with h5py rather than through nexusformat (faster)
+        # storage sets the chunking and compression of the data, energy and detector datasets (see nxspe_h5opts)
+        # template is an instrument template file (see write_template) to copy (or link to, if link=True) the
+        # instrument group from; it is created if it does not exist (or rebuilt if it is for a different instrument
+        # or detector.dat). Templates are always used with h5py, and the detector tables have the template storage.
         if not outfile.endswith('.nxspe'):
             outfile += '.nxspe'
-        with nxopen(outfile, 'w') as root:
+        if isinstance(data, str):
+            data = NXSPEData.from_spe(data)
+        self._check_template_options(template, backend, storage)
+        if backend == 'h5py' or template is not None:
+            return self._nxspe_h5py(outfile, ei, det_file, storage, template, link, data)
+        elif backend not in [None, 'nexus']:
+            raise RuntimeError(f'Unknown backend "{backend}"')
+        report_progress('instrument', 0.)
+        with _nexus_lock, ibex_strings(), nxopen(outfile, 'w') as root:
             root['w1'] = NXentry()
             root['w1/definition'] = NXfield('NXSPE', version='1.3')
-            root['w1/NXSPE_info'] = NXcollection(fixed_energy=NXfield(ei, units='meV'),
-                                                           ki_over_kf_scaling=True,
-                                                           psi=NXfield(np.nan, units='degrees'))
+            root['w1/NXSPE_info'] = self._nxspe_info(ei)
             root['w1/instrument'] = self.inst
             if self.sample is not None:
                 root['w1/sample'] = self.sample
-            if self.data is None:
-                n = 5
-                dmat = np.random.rand(n, n)
-                emat = np.random.rand(n, n) / 10.
-                th = np.linspace(-25, 120, n)
-                phi = np.zeros(n)
-                en = np.linspace(ei/20, ei*0.9, n)
-                wd = np.ones(n) / 10.
-                dd = np.ones(n) * 4.
-                dat = NXdata(data=NXfield(dmat, axes='polar:energy', signal=1), error=emat,
-                             errors=emat, energy=NXfield(en, units='meV'),
-                             azimuthal=th, azimuthal_width=wd, polar=phi, polar_width=wd, distance=dd)
-                root['w1/data'] = dat
-            else:
-                root['w1/data'] = self.data
-            if det_file:
-                for ky, val in self._parse_det(det_file).items():
+            if det_file and not h5py.is_hdf5(det_file):
+                h5opts = lambda shape, dtype: nxspe_h5opts(shape, dtype, 'detector', storage)
+                for ky, val in self._parse_det(det_file, h5opts).items():
                     root[f'w1/{ky}'] = val
+        report_progress('instrument', 1.)
+        # The data (copied in blocks of detectors, streamed or referenced) and referenced detector tables are
+        # written directly with h5py
+        with h5py.File(outfile, 'a') as root:
+            if data is not None:
+                self._write_nxspe_data_h5py(root['w1'], data, storage)
+            else:
+                self._write_nxdata_h5py(root['w1'], ei, storage)
+            if det_file and h5py.is_hdf5(det_file):
+                self._write_det_h5py(root['w1'], det_file)
 
 
-    def to_icp(self, outfile, det_file=None):
+    def to_icp(self, outfile, det_file=None, backend=None, template=None, link=False):
+        # backend='h5py' writes the file directly with h5py rather than through nexusformat (faster)
+        # template and link are as for to_nxspe
         if not outfile.endswith('.nxs'):
             outfile += '.nxs'
-        with nxopen(outfile, 'w') as root:
+        self._check_template_options(template, backend)
+        if backend == 'h5py' or template is not None:
+            return self._icp_h5py(outfile, det_file, template, link)
+        elif backend not in [None, 'nexus']:
+            raise RuntimeError(f'Unknown backend "{backend}"')
+        report_progress('instrument', 0.)
+        with _nexus_lock, ibex_strings(), nxopen(outfile, 'w') as root:
             root['mantid_workspace_1'] = NXentry()
             root['mantid_workspace_1/program_name'] = NXfield('eniius', version=VERSION)
             root['mantid_workspace_1/instrument'] = self.inst
-            if det_file:
+            if det_file and not h5py.is_hdf5(det_file):
                 for ky, val in self._parse_det(det_file).items():
                     root[f'mantid_workspace_1/{ky}'] = val
+        report_progress('instrument', 1.)
+        if det_file and h5py.is_hdf5(det_file):
+            with h5py.File(outfile, 'a') as root:
+                self._write_det_h5py(root['mantid_workspace_1'], det_file)
+
+
+    def write_template(self, template, det_file=None):
+        # Writes the instrument group (including the detector tables) to an HDF5 template file, from which it
+        # is copied or linked by to_icp and to_nxspe for later files with the same instrument (and detector.dat)
+        # The instrument group has the checksum of the instrument and detector.dat (see inst_checksum)
+        tmpfile = f'{template}.{os.getpid()}.tmp'
+        try:
+            with h5py.File(tmpfile, 'w') as root:
+                self._write_inst_h5py(root, det_file)
+                root['instrument'].attrs['eniius_checksum'] = self.inst_checksum(det_file)
+            os.replace(tmpfile, template)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+
+    def update_template(self, template, det_file=None):
+        # Writes a template file if it does not exist or is not for this instrument and detector.dat (e.g. a
+        # different incident energy or detector.dat was used); returns True if the template was (re)written
+        try:
+            with h5py.File(template, 'r') as root:
+                if root['instrument'].attrs.get('eniius_checksum', None) == self.inst_checksum(det_file):
+                    return False
+        except (OSError, KeyError):
+            pass
+        self.write_template(template, det_file)
+        return True
+
+
+    def inst_checksum(self, det_file=None):
+        # Checksum of the instrument and detector.dat, which identifies an instrument group written by eniius
+        return nx_checksum(self.inst) + (file_hash(det_file) if det_file else '')
+
+
+    @staticmethod
+    def _check_template_options(template, backend, storage='auto'):
+        if template is None:
+            return
+        if backend not in [None, 'h5py']:
+            raise RuntimeError(f'Instrument templates are only used with the h5py backend, not "{backend}"')
+        det_storage = _class_storage(storage, 'detector')
+        if not (isinstance(det_storage, str) and det_storage == 'auto'):
+            raise RuntimeError('The storage of the detector tables cannot be set when using an instrument template')
+
+
+    def _write_inst_h5py(self, entry, det_file, h5opts=None, template=None, link=False):
+        report_progress('instrument', 0.)
+        if template is None:
+            h5_write(h5_group(entry, 'instrument', self.inst.nxclass), self.inst)
+            report_progress('instrument', 1.)
+            if det_file:
+                self._write_det_h5py(entry, det_file, h5opts)
+            return
+        self.update_template(template, det_file)
+        if link:
+            entry['instrument'] = h5py.ExternalLink(_relative_path(entry.file, template), '/instrument')
+        else:
+            with h5py.File(template, 'r') as src:
+                src.copy(src['instrument'], entry, name='instrument')
+            # The output is the same as without the template (inject sets the checksum itself)
+            del entry['instrument'].attrs['eniius_checksum']
+        report_progress('instrument', 1.)
+
 
+    def inject(self, filename, det_file=None, entry=None, template=None, link=False):
+        # Writes (or replaces) only the instrument group of an existing NeXus file, without reading or copying
+        # any other data. entry is the name of the NXentry (default: the first one). Does nothing if the
+        # instrument group was already written by eniius with the same instrument and detector.dat (or links to
+        # the same template). Returns True if the file was modified.
+        # Note that replacing a group does not reclaim its space in the file.
+        link = link and template is not None
+        checksum = self.inst_checksum(det_file)
+        with h5py.File(filename, 'r') as root:
+            entry = self._find_entry(root, entry)
+            current = root[entry].get('instrument', getlink=True)
+            if link and isinstance(current, h5py.ExternalLink):
+                if (current.filename, current.path) == (_relative_path(root, template), '/instrument'):
+                    return False
+            elif not link and isinstance(current, h5py.HardLink):
+                if root[f'{entry}/instrument'].attrs.get('eniius_checksum', None) == checksum:
+                    return False
+        with h5py.File(filename, 'a') as root:
+            if current is not None:
+                del root[f'{entry}/instrument']
+            self._write_inst_h5py(root[entry], det_file, None, template, link)
+            if not link:
+                if template is not None:
+                    # The checksum of the group actually copied (the template is rebuilt if out of date)
+                    with h5py.File(template, 'r') as src:
+                        checksum = src['instrument'].attrs['eniius_checksum']
+                root[f'{entry}/instrument'].attrs['eniius_checksum'] = checksum
+        return True
 
-    def _parse_det(self, det_file):
-        # Assumes ISIS format; cols=(det#, delta, L2, code, theta, phi, W_xyz, a_xyz, det_123)
-        with open(det_file, 'r') as f:
-            titles = [next(f) for x in range(3)][2].split()
-            if titles[0] == 'det' and titles[1] == 'no':
-                titles = titles[1:]
-            titles = ','.join(titles[6:])
-        detdat = np.loadtxt(det_file, skiprows=3)
+
+    @staticmethod
+    def _find_entry(root, entry=None):
+        if entry is not None:
+            if entry not in root:
+                raise RuntimeError(f'File {root.filename} has no entry "{entry}"')
+            return entry
+        for name, obj in root.items():
+            if isinstance(obj, h5py.Group) and obj.attrs.get('NX_class', b'') in [b'NXentry', 'NXentry']:
+                return name
+        raise RuntimeError(f'File {root.filename} has no NXentry group')
+
+
+    def _nxspe_h5py(self, outfile, ei, det_file, storage, template=None, link=False, source=None):
+        with h5py.File(outfile, 'w') as root:
+            entry = h5_group(root, 'w1', 'NXentry')
+            h5_field(entry, 'definition', 'NXSPE', {'version':'1.3'})
+            h5_write(h5_group(entry, 'NXSPE_info', 'NXcollection'), self._nxspe_info(ei))
+            self._write_inst_h5py(entry, det_file, lambda shape, dtype: nxspe_h5opts(shape, dtype, 'detector', storage),
+                                  template, link)
+            if self.sample is not None:
+                h5_write(h5_group(entry, 'sample', self.sample.nxclass), self.sample)
+            if source is not None:
+                self._write_nxspe_data_h5py(entry, source, storage)
+            else:
+                self._write_nxdata_h5py(entry, ei, storage)
+
+
+    @staticmethod
+    def _write_nxspe_data_h5py(entry, source, storage):
+        # Writes the NXSPE data group from an NXSPEData source one block of detectors at a time,
+        # or references the datasets of an NXSPEReference source
+        group = h5_group(entry, 'data', 'NXdata')
+        if isinstance(source, NXSPEReference):
+            for name, value in source.fields.items():
+                if isinstance(value, tuple):
+                    h5_reference(group, name, *value, link=source.link)
+                else:
+                    value = np.asarray(value)
+                    attrs = {'units':'meV'} if name == 'energy' else None
+                    h5_field(group, name, value, attrs, nxspe_h5opts(value.shape, value.dtype,
+                                                                     NXSPE_CLASSES.get(name, 'detector'), storage))
+            if isinstance(source.fields['error'], tuple) and source.link:
+                h5_reference(group, 'errors', *source.fields['error'], link=True)
+            else:
+                group['errors'] = group['error']
+            if not source.link and 'signal' not in group['data'].attrs:
+                group['data'].attrs['axes'] = 'polar:energy'
+                group['data'].attrs['signal'] = 1
+            return
+        shape = (source.ndet, source.nen)
+        dsets = [group.create_dataset(name, shape=shape, dtype=source.dtype,
+                                      **nxspe_h5opts(shape, source.dtype, 'data', storage)) for name in ['data', 'error']]
+        dsets[0].attrs['axes'] = 'polar:energy'
+        dsets[0].attrs['signal'] = 1
+        i0 = 0
+        for signal, error in source.iter_blocks():
+            i1 = i0 + len(signal)
+            if i1 > source.ndet:
+                raise RuntimeError(f'Data source has more than the expected {source.ndet} detectors')
+            dsets[0][i0:i1] = signal
+            dsets[1][i0:i1] = error
+            i0 = i1
+            report_progress('data', i0 / source.ndet)
+        if i0 != source.ndet:
+            raise RuntimeError(f'Data source has {i0} detectors, expected {source.ndet}')
+        group['errors'] = dsets[1]
+        h5_field(group, 'energy', source.energy, {'units':'meV'},
+                 nxspe_h5opts(source.energy.shape, source.energy.dtype, 'energy', storage))
+        for name, value in source.detector_fields.items():
+            value = np.asarray(value)
+            h5_field(group, name, value, None, nxspe_h5opts(value.shape, value.dtype, 'detector', storage))
+
+
+    def _icp_h5py(self, outfile, det_file, template=None, link=False):
+        with h5py.File(outfile, 'w') as root:
+            entry = h5_group(root, 'mantid_workspace_1', 'NXentry')
+            h5_field(entry, 'program_name', 'eniius', {'version':VERSION})
+            self._write_inst_h5py(entry, det_file, None, template, link)
+
+
+    @staticmethod
+    def _nxspe_info(ei):
+        return NXcollection(fixed_energy=NXfield(ei, units='meV'), ki_over_kf_scaling=True,
+                            psi=NXfield(np.nan, units='degrees'))
+
+
+    @staticmethod
+    def _default_data(ei):
+        # Dummy data for an instrument-only NXSPE file
+        n = 5
+        dmat = np.random.rand(n, n)
+        emat = np.random.rand(n, n) / 10.
+        th = np.linspace(-25, 120, n)
+        phi = np.zeros(n)
+        en = np.linspace(ei/20, ei*0.9, n)
+        wd = np.ones(n) / 10.
+        dd = np.ones(n) * 4.
+        return NXdata(data=NXfield(dmat, axes='polar:energy', signal=1), error=emat,
+                      errors=emat, energy=NXfield(en, units='meV'),
+                      azimuthal=th, azimuthal_width=wd, polar=phi, polar_width=wd, distance=dd)
+
+
+    def _write_nxdata_h5py(self, entry, ei, storage):
+        # Writes the data group of the input (or a placeholder) with the storage options of its fields set according
+        # to their dataset class; large fields are copied in blocks of rows rather than read into memory at once
+        data = self._default_data(ei) if self.data is None else self.data
+        h5_write(h5_group(entry, 'data', data.nxclass), data, h5opts=lambda name, obj:
+                 nxspe_h5opts(obj.shape, obj.dtype, NXSPE_CLASSES.get(name, 'detector'), storage))
+
+
+    def _det_tables(self, det_file):
+        # Returns the detector and monitor tables as {path: {field: (values, attributes)}}
+        # The tables are only read once per Writer, so are shared when writing several output formats
+        if det_file in self._det:
+            return self._det[det_file]
+        titles, tables = read_detector_dat(det_file)
+        rv = {}
+        for fnm in DET_CODES.keys():
+            detdat = tables[fnm]
+            fd = {f'number_of_{fnm}': (np.array(detdat.shape[0], dtype='uint64'), {})}
+            for j, (name, dtype, units) in enumerate(DET_COLUMNS):
+                if name is not None:
+                    fd[name] = (detdat[:,j].astype(dtype), units)
+            fd['user_table_titles'] = (titles, {})
+            for j in range(len(DET_COLUMNS), detdat.shape[1]):
+                fd[f'user_table_{j-5}'] = (detdat[:,j], {})
+            rv['instrument/physical_' + fnm] = fd
+        self._det[det_file] = rv
+        return rv
+
+
+    def _parse_det(self, det_file, h5opts=None):
+        # h5opts is an optional function (shape, dtype) -> h5py dataset options (otherwise nexusformat defaults)
         rv = {}
-        for fnm, idn in zip(['detectors', 'monitors'], [2, 1]):
-            idx = np.where(detdat[:,3] == idn)[0]
-            fd = {f'number_of_{fnm}': NXfield(np.array(len(idx), dtype='uint64'))}
-            fd['detector_number'] = NXfield(detdat[idx,0].astype(np.int32))
-            fd['detector_offset'] = NXfield(detdat[idx,1])
-            fd['distance'] = NXfield(detdat[idx,2], units='metre')
-            fd['polar_angle'] = NXfield(detdat[idx,4], units='degree')
-            fd['azimuthal_angle'] = NXfield(detdat[idx,5], units='degree')
-            fd['user_table_titles'] = NXfield(titles)
-            for j in range(6, detdat.shape[1]):
-                fd[f'user_table_{j-5}'] = NXfield(detdat[idx,j])
-            assert len(titles.split(',')) == detdat.shape[1]-6, "Number of titles not commensurate with table width"
-            rv['instrument/physical_' + fnm] = NXdetector(**fd)
+        for ky, fd in self._det_tables(det_file).items():
+            fields = {k:NXfield(v, **attrs) for k, (v, attrs) in fd.items()}
+            if h5opts is not None:
+                for field in fields.values():
+                    field._h5opts = h5opts(field.shape, field.dtype)
+            rv[ky] = NXdetector(**fields)
         return rv
+
+
+    def _write_det_h5py(self, entry, det_file, h5opts=None):
+        if h5py.is_hdf5(det_file):
+            return self._reference_det_h5py(entry, det_file)
+        tables = self._det_tables(det_file)
+        for i, (ky, fd) in enumerate(tables.items()):
+            group = h5_group(entry, ky, 'NXdetector')
+            for k, (v, attrs) in fd.items():
+                h5_field(group, k, v, attrs, None if h5opts is None else h5opts(np.shape(v), np.asarray(v).dtype))
+            report_progress('detectors', (i + 1) / len(tables))
+
+
+    @staticmethod
+    def _reference_det_h5py(entry, det_file):
+        # References (as virtual datasets) the detector tables in an HDF5 file, e.g. an earlier output or template
+        groups = {}
+        with h5py.File(det_file, 'r') as src:
+            def visit(name, obj):
+                for fnm in DET_CODES.keys():
+                    if name.endswith(f'physical_{fnm}') and isinstance(obj, h5py.Group) and fnm not in groups:
+                        groups[fnm] = [(k, v.name) for k, v in obj.items() if isinstance(v, h5py.Dataset)]
+            src.visititems(visit)
+        if len(groups) == 0:
+            raise RuntimeError(f'No physical_detectors or physical_monitors groups in {det_file}')
+        for fnm, datasets in groups.items():
+            group = h5_group(entry, f'instrument/physical_{fnm}', 'NXdetector')
+            for name, path in datasets:
+                h5_reference(group, name, det_file, path)
+
+
+# Columns of an ISIS detector.dat file: (NeXus name, dtype, attributes); user table columns follow these
+DET_COLUMNS = [('detector_number', np.int32, {}),
+               ('detector_offset', np.float64, {}),
+               ('distance', np.float64, {'units':'metre'}),
+               (None, np.int32, {}),   # code: 1 = monitor, 2 = detector
+               ('polar_angle', np.float64, {'units':'degree'}),
+               ('azimuthal_angle', np.float64, {'units':'degree'})]
+DET_CODES = {'detectors':2, 'monitors':1}
+
+
+def read_detector_dat(det_file, use_cache=True):
+    # Reads an ISIS format detector.dat file in a single pass over the file
+    # cols=(det#, delta, L2, code, theta, phi, W_xyz, a_xyz, det_123)
+    # Returns the user table titles (comma separated) and a dict of the detector and monitor rows
+    # Parsed tables are cached (memory-mapped) keyed on the checksum of the file, if use_cache is True
+    if use_cache and DET_CACHE.enabled:
+        key = DET_CACHE.key(det_file)
+        cached = DET_CACHE.load_arrays(key)
+        if cached is not None:
+            return str(cached.pop('titles')), cached
+    with open(det_file, 'r') as f:
+        titles = [next(f) for x in range(3)][2].split()
+        detdat = np.loadtxt(f, ndmin=2)
+    if titles[0] == 'det' and titles[1] == 'no':
+        titles = titles[1:]
+    titles = ','.join(titles[len(DET_COLUMNS):])
+    assert len(titles.split(',')) == detdat.shape[1] - len(DET_COLUMNS), \
+        "Number of titles not commensurate with table width"
+    # Partitions rows by the code column; each table keeps the file order of its rows
+    code = detdat[:,3]
+    tables = {fnm: np.compress(code == idn, detdat, axis=0) for fnm, idn in DET_CODES.items()}
+    if use_cache and DET_CACHE.enabled:
+        DET_CACHE.save_arrays(key, {'titles':np.array(titles), **tables})
+    return titles, tables
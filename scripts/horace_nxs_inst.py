@@ -8,8 +8,7 @@ from nexusformat.nexus import *
 
 def create_inst_nxs(outfile, inst_fun, ei, det_file=None):
     wrapper = eniius.Eniius(inst_fun(ei), det_file)
-    wrapper.to_nxspe(f'{outfile}.nxspe')
-    wrapper.to_icp(f'{outfile}.nxs')
+    wrapper.export(outfile, ['nxspe', 'icp'])
 
 
 if __name__ == '__main__':
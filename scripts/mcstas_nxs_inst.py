@@ -7,8 +7,7 @@ import eniius
 def mcstas2nxs(instrfile):
     detfile = os.path.join(os.path.dirname(eniius.__file__), 'detector.dat')
     wrapper = eniius.Eniius.from_mcstas(instrfile, detfile)
-    wrapper.to_json(f'mcstas_{wrapper.name}.json')
-    wrapper.to_icp(f'mcstas_{wrapper.name}.nxs')
+    wrapper.export(f'mcstas_{wrapper.name}', ['json', 'icp'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Simple timing benchmarks for eniius; run with `python run_benchmarks.py [name ...]`
+import subprocess
+import timeit
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+NREPEAT = 5
+
+
+def _time_subprocess(code, nrepeat=NREPEAT):
+    # Minimum wall time for running a snippet of code in a fresh interpreter
+    cmd = [sys.executable, '-c', code]
+    env = {**os.environ, 'PYTHONPATH': sys.path[0]}
+    return min(timeit.repeat(lambda: subprocess.run(cmd, check=True, env=env), number=1, repeat=nrepeat))
+
+
+def bench_import():
+    # Startup time of `import eniius` with lazy submodules compared to importing everything
+    t_bare = _time_subprocess('pass')
+    t_lazy = _time_subprocess('import eniius')
+    t_horace = _time_subprocess('import eniius; eniius.horace; eniius.Eniius')
+    t_full = _time_subprocess('import eniius, mcstasscript, scipy.io; eniius.mcstas; eniius.horace; eniius.nexus; eniius.Eniius')
+    print(f'Bare interpreter:           {t_bare:8.4f}s')
+    print(f'import eniius (lazy):       {t_lazy:8.4f}s')
+    print(f'import eniius + horace:     {t_horace:8.4f}s')
+    print(f'import eniius (everything): {t_full:8.4f}s')
+
+
+def bench_version():
+    # Time to resolve __version__ from the cached record compared to running versioneer (git)
+    _time_subprocess('import eniius; eniius.__version__', nrepeat=1)  # Makes sure the record exists
+    t_record = _time_subprocess('import eniius; eniius.__version__')
+    t_versioneer = _time_subprocess('import eniius._version as v; v.get_versions()')
+    print(f'__version__ (cached record): {t_record:8.4f}s')
+    print(f'__version__ (versioneer):    {t_versioneer:8.4f}s')
+
+
+def bench_let_divergence():
+    # LET divergence profiles computed per Ei in a loop compared to a single batch call
+    import numpy as np
+    import eniius.horace
+    eis = np.linspace(1., 50., 500)
+    eniius.horace.get_let_tables()
+    t_loop = min(timeit.repeat(lambda: [eniius.horace.get_let_divergences(ei) for ei in eis], number=1, repeat=NREPEAT))
+    t_batch = min(timeit.repeat(lambda: [eniius.horace.interp_let_divergence(eis, direction=dd)
+                                         for dd in ['horiz', 'vert']], number=1, repeat=NREPEAT))
+    t_load = _time_subprocess('import eniius.horace; eniius.horace.get_let_tables()')
+    print(f'{len(eis)} Ei, get_let_divergences loop:  {t_loop:8.4f}s')
+    print(f'{len(eis)} Ei, interp_let_divergence batch: {t_batch:8.4f}s')
+    print(f'Load tables in new process (cached):  {t_load:8.4f}s')
+
+
+def bench_batch_instruments():
+    # Building LET instruments one Ei at a time compared to the batch factory
+    import numpy as np
+    import eniius.horace
+    eis = np.linspace(2., 40., 200)
+    t_loop = min(timeit.repeat(lambda: [eniius.horace.let_instrument(ei) for ei in eis], number=1, repeat=NREPEAT))
+    t_batch = min(timeit.repeat(lambda: eniius.horace.let_instruments(eis), number=1, repeat=NREPEAT))
+    print(f'{len(eis)} Ei, let_instrument loop: {t_loop:8.4f}s')
+    print(f'{len(eis)} Ei, let_instruments:     {t_batch:8.4f}s')
+
+
+def bench_moderator_pulse():
+    # Moderator pulses computed one Ei at a time compared to a single vectorised call
+    import numpy as np
+    import eniius.horace
+    eis = np.linspace(5., 500., 2000)
+    eniius.horace.get_moderator_table('merlin')
+    t_loop = min(timeit.repeat(lambda: [eniius.horace.get_moderator_time_pulse('merlin', ei) for ei in eis],
+                               number=1, repeat=NREPEAT))
+    t_batch = min(timeit.repeat(lambda: eniius.horace.get_moderator_time_pulse('merlin', eis), number=1, repeat=NREPEAT))
+    print(f'{len(eis)} Ei, get_moderator_time_pulse loop:  {t_loop:8.4f}s')
+    print(f'{len(eis)} Ei, get_moderator_time_pulse array: {t_batch:8.4f}s')
+
+
+def bench_instr_parser():
+    # Parsing the bundled instr files with the native parser compared to mcstasscript (without the disk cache)
+    import eniius.mcstas
+    instrs = ['isis_merlin.instr', 'isis_let.instr', 'isis_maps.instr']
+    for parser in ['native', 'mcstasscript']:
+        eniius.mcstas.get_instr_record(instrs[0], use_cache=False, parser=parser)
+        t_parse = min(timeit.repeat(lambda: [eniius.mcstas.get_instr_record(ff, use_cache=False, parser=parser)
+                                             for ff in instrs], number=1, repeat=NREPEAT))
+        print(f'{len(instrs)} instr files, {parser + ":":13s} {t_parse:8.4f}s')
+
+
+def bench_component_index():
+    # Creating a mcstasscript instrument which scans the component library compared to using the component
+    # index, and loading the index in a new process from the disk cache
+    import mcstasscript
+    import eniius.comps
+    eniius.comps.get_index()
+    t_scan = min(timeit.repeat(lambda: mcstasscript.McStas_instr('scan', package_path=eniius.comps.comps_path),
+                               number=1, repeat=NREPEAT))
+    t_index = min(timeit.repeat(lambda: eniius.comps.new_instr('indexed'), number=1, repeat=NREPEAT))
+    t_build = min(timeit.repeat(lambda: eniius.comps.build_index(), number=1, repeat=NREPEAT))
+    t_load = _time_subprocess('import eniius.comps; eniius.comps.get_index()')
+    print(f'McStas_instr (scan library): {t_scan:8.4f}s')
+    print(f'new_instr (index):           {t_index:8.4f}s')
+    print(f'Build index:                 {t_build:8.4f}s')
+    print(f'Load index in new process:   {t_load:8.4f}s')
+
+
+def bench_transform_chain():
+    # Resolving the transformations of synthetic instruments of components each positioned RELATIVE PREVIOUS
+    import warnings
+    import numpy as np
+    import eniius.mcstas
+    rng = np.random.default_rng(1)
+    for n in [100, 1000, 5000]:
+        components = [eniius.mcstas.McStasCompRecord(
+                          {}, name=f'arm{ii}', component_name='Arm', category='samples' if ii == n // 2 else 'misc',
+                          AT_data=list(rng.uniform(-1, 1, 3)), ROTATED_data=list(rng.uniform(-20, 20, 3)),
+                          AT_relative='ABSOLUTE' if ii == 0 else 'RELATIVE PREVIOUS',
+                          ROTATED_relative='ABSOLUTE' if ii == 0 else 'RELATIVE PREVIOUS', EXTEND='')
+                      for ii in range(n)]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            t_resolve = min(timeit.repeat(lambda: eniius.mcstas.NXMcStas(components), number=1, repeat=NREPEAT))
+        print(f'{n:5d} components, NXMcStas: {t_resolve:8.4f}s')
+
+
+def bench_affine_stack():
+    # Computing the NeXus transformation fields of many components one by one compared to in one batch
+    import numpy as np
+    import eniius.mcstas
+    rng = np.random.default_rng(1)
+    for n in [100, 1000, 10000]:
+        stack = eniius.mcstas.AffineStack.from_euler_translation(rng.uniform(-180, 180, (n, 3)),
+                                                                 rng.uniform(-1, 1, (n, 3)))
+        affines = [stack[ii] for ii in range(n)]
+        t_single = min(timeit.repeat(lambda: [tr.NXfield() for tr in affines], number=1, repeat=NREPEAT))
+        t_batch = min(timeit.repeat(lambda: stack.NXfields(), number=1, repeat=NREPEAT))
+        print(f'{n:5d} transformations, AffineRotate: {t_single:8.4f}s, AffineStack: {t_batch:8.4f}s')
+
+
+def bench_axisrot():
+    # Extracting the rotation axis and angle by eigendecomposition (as previously) compared to the closed
+    # form used by AffineRotate (for single matrices) and AffineStack (for a batch)
+    import numpy as np
+    import eniius.mcstas
+    def eig_axisrot(rotmat):
+        dd, vv = np.linalg.eig(rotmat)
+        axis = vv[:, np.where(np.abs(dd - 1) < 1.e-6)[0][0]]
+        angle = np.degrees(np.arccos((np.trace(rotmat) - 1.) / 2.))
+        if np.sum(np.abs(rotmat - eniius.mcstas.AffineRotate.rodrigues(axis, angle))) > 1.e-5:
+            angle = -angle
+        return axis, angle
+    rng = np.random.default_rng(1)
+    n = 1000
+    stack = eniius.mcstas.AffineStack.from_euler_translation(rng.uniform(-180, 180, (n, 3)), np.zeros((n, 3)))
+    affines = [stack[ii] for ii in range(n)]
+    t_eig = min(timeit.repeat(lambda: [eig_axisrot(tr.transform[:3, :3]) for tr in affines], number=1, repeat=NREPEAT))
+    t_single = min(timeit.repeat(lambda: [tr.axisrot() for tr in affines], number=1, repeat=NREPEAT))
+    t_batch = min(timeit.repeat(lambda: stack.axisrot(), number=1, repeat=NREPEAT))
+    print(f'{n} rotations, eig: {t_eig:8.4f}s, AffineRotate: {t_single:8.4f}s, AffineStack: {t_batch:8.4f}s')
+
+
+def bench_write_icp():
+    # Writing an ISISICP instrument file through nexusformat compared to writing directly with h5py,
+    # and to copying or linking the instrument group from a template file
+    import tempfile
+    import eniius.horace
+    detdat = os.path.join(os.path.dirname(os.path.realpath(eniius.__file__)), 'instruments', 'detector.dat')
+    writer = eniius.writer.Writer(eniius.horace.merlin_instrument(120.))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outfile = os.path.join(tmpdir, 'merlin.nxs')
+        writer.to_icp(outfile, detdat)
+        t_nexus = min(timeit.repeat(lambda: writer.to_icp(outfile, detdat), number=1, repeat=NREPEAT))
+        t_h5py = min(timeit.repeat(lambda: writer.to_icp(outfile, detdat, backend='h5py'), number=1, repeat=NREPEAT))
+        template = os.path.join(tmpdir, 'template.h5')
+        writer.write_template(template, detdat)
+        t_copy = min(timeit.repeat(lambda: writer.to_icp(outfile, detdat, template=template), number=1, repeat=NREPEAT))
+        t_link = min(timeit.repeat(lambda: writer.to_icp(outfile, detdat, template=template, link=True),
+                                   number=1, repeat=NREPEAT))
+    print(f'to_icp (nexusformat):     {t_nexus:8.4f}s')
+    print(f'to_icp (h5py):            {t_h5py:8.4f}s')
+    print(f'to_icp (template copy):   {t_copy:8.4f}s')
+    print(f'to_icp (template link):   {t_link:8.4f}s')
+
+
+def bench_export():
+    # Writing the NXSPE and ISISICP files one after another compared to a single (concurrent) export call
+    import tempfile
+    import eniius.horace
+    detdat = os.path.join(os.path.dirname(os.path.realpath(eniius.__file__)), 'instruments', 'detector.dat')
+    wrapper = eniius.Eniius(eniius.horace.merlin_instrument(120.), detdat)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outfile = os.path.join(tmpdir, 'merlin')
+        def sequential():
+            wrapper.to_nxspe(outfile)
+            wrapper.to_icp(outfile)
+        t_seq = min(timeit.repeat(sequential, number=1, repeat=NREPEAT))
+        for backend in ['nexus', 'h5py']:
+            for parallel in [None, 'thread', 'process']:
+                t_exp = min(timeit.repeat(lambda: wrapper.export(outfile, ['nxspe', 'icp'], backend, parallel),
+                                          number=1, repeat=NREPEAT))
+                print(f'{"export (" + backend + ", " + str(parallel) + "):":25s}{t_exp:8.4f}s')
+    print(f'{"to_nxspe + to_icp:":25s}{t_seq:8.4f}s')
+
+
+BENCHMARKS = {k[6:]:v for k, v in globals().items() if k.startswith('bench_')}
+
+
+if __name__ == '__main__':
+    for name in (sys.argv[1:] if len(sys.argv) > 1 else BENCHMARKS.keys()):
+        print(f'--- {name} ---')
+        BENCHMARKS[name]()
@@ -3,8 +3,13 @@ import unittest
 import numpy as np
 import tempfile
 import os
+import sys
+import subprocess
+import warnings
+import h5py
 import nexusformat.nexus as nexus
 import eniius
+import eniius.cache
 
 class EniiusTest(unittest.TestCase):
 
@@ -13,6 +18,7 @@ class EniiusTest(unittest.TestCase):
         cls.tmpdir = tempfile.TemporaryDirectory()
         cls.rootdir = os.path.dirname(os.path.realpath(eniius.__file__))
         cls.detdat = os.path.join(cls.rootdir, 'instruments', 'detector.dat')
+        eniius.cache.CACHE_DIR = os.path.join(cls.tmpdir.name, 'cache')
 
     @classmethod
     def tearDownClass(cls):
@@ -20,6 +26,725 @@ class EniiusTest(unittest.TestCase):
             f.write('success')
         cls.tmpdir.cleanup()
 
+    def test_lazy_import(self):
+        code = 'import sys, eniius; print(",".join(sorted(sys.modules)))'
+        env = {**os.environ, 'PYTHONPATH': os.path.dirname(self.rootdir)}
+        modules = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                                 capture_output=True, text=True).stdout.strip().split(',')
+        for mod in ['eniius.mcstas', 'eniius.horace', 'eniius.nexus', 'mcstasscript', 'scipy.io']:
+            self.assertNotIn(mod, modules)
+        self.assertTrue(hasattr(eniius, 'horace'))
+        self.assertTrue(hasattr(eniius, 'Eniius'))
+
+    def test_version_without_subprocess(self):
+        # Once the version record exists, __version__ must resolve without forking (git) processes
+        version = eniius.__version__
+        code = ('import subprocess\n'
+                'def fail(*args, **kwargs): raise RuntimeError("subprocess called")\n'
+                'subprocess.Popen = fail\n'
+                'import eniius; print(eniius.__version__)')
+        env = {**os.environ, 'PYTHONPATH': os.path.dirname(self.rootdir)}
+        out = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                             capture_output=True, text=True).stdout.strip()
+        self.assertEqual(out, version)
+
+    def test_version_record_key(self):
+        from eniius._version_record import source_key
+        repo = os.path.join(self.tmpdir.name, 'repo')
+        git = lambda *args: subprocess.run(['git', '-C', repo, '-c', 'user.name=test', '-c', 'user.email=test@test',
+                                            *args], check=True, capture_output=True)
+        os.makedirs(repo)
+        git('init', '-q')
+        # An unborn HEAD (no loose ref or packed-refs)
+        self.assertIsNotNone(source_key(repo))
+        with open(os.path.join(repo, 'a.txt'), 'w') as f:
+            f.write('a')
+        git('add', 'a.txt')
+        git('commit', '-q', '-m', 'a')
+        clean = source_key(repo)
+        with open(os.path.join(repo, 'a.txt'), 'w') as f:
+            f.write('ab')
+        dirty = source_key(repo)
+        self.assertNotEqual(dirty, clean)
+        git('checkout', '-q', '--', 'a.txt')
+        self.assertEqual(source_key(repo), clean)
+
+    def test_disk_cache(self):
+        cache = eniius.cache.DiskCache('test', max_size=2**20, max_entries=2)
+        keys = [cache.key(self.detdat, ii) for ii in range(3)]
+        self.assertIsNone(cache.load(keys[0]))
+        cache.save(keys[0], {'a':1})
+        cache.save(keys[1], [2])
+        self.assertEqual(cache.load(keys[0]), {'a':1})
+        os.utime(cache.path(keys[1]), ns=(0, 0))
+        cache.save(keys[2], 3)   # Evicts the least recently used entry (keys[1])
+        self.assertEqual(len(cache.entries()), 2)
+        self.assertIsNone(cache.load(keys[1]))
+        cache.invalidate(keys[0])
+        self.assertIsNone(cache.load(keys[0]))
+        eniius.cache.clear_cache('test')
+        self.assertEqual(len(cache.entries()), 0)
+        # Threads saving the same key at once all succeed
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            paths = list(executor.map(lambda ii: cache.save(keys[0], list(range(ii * 1000))), range(40)))
+        self.assertNotIn(None, paths)
+        self.assertEqual(len(cache.load(keys[0])) % 1000, 0)
+        self.assertFalse([fn for fn in os.listdir(cache.folder) if fn.endswith('.tmp')])
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            paths = list(executor.map(lambda ii: cache.save_arrays(keys[1], {'a':np.full(20000, ii), 'b':np.full(20000, ii)}),
+                                      range(40)))
+        self.assertNotEqual(paths.count(None), len(paths))
+        arrays = cache.load_arrays(keys[1])
+        self.assertEqual(np.unique(arrays['a']).tolist(), np.unique(arrays['b']).tolist())
+        self.assertEqual(len(np.unique(arrays['a'])), 1)
+        self.assertFalse([fn for fn in os.listdir(cache.folder) if fn.endswith('.tmp')])
+
+    def test_mcstas_instr_cache(self):
+        instrfile = os.path.join(self.rootdir, 'instruments', 'isis_merlin.instr')
+        eniius.cache.clear_cache('instr')
+        rec1 = eniius.mcstas.get_instr_record(instrfile)
+        self.assertEqual(len(eniius.mcstas.INSTR_CACHE.entries()), 1)
+        rec2 = eniius.mcstas.get_instr_record(instrfile)
+        self.assertEqual(rec1.name, rec2.name)
+        for c1, c2 in zip(rec1.component_list, rec2.component_list):
+            self.assertEqual(c1.__dict__, c2.__dict__)
+
+    def test_native_instr_parser(self):
+        for instr in ['isis_merlin', 'isis_let', 'isis_maps']:
+            instrfile = os.path.join(self.rootdir, 'instruments', f'{instr}.instr')
+            rec1 = eniius.mcstas.get_instr_record(instrfile, use_cache=False, parser='native')
+            rec2 = eniius.mcstas.get_instr_record(instrfile, use_cache=False, parser='mcstasscript')
+            self.assertEqual((rec1.name, rec1.parameters), (rec2.name, rec2.parameters))
+            self.assertEqual([c.__dict__ for c in rec1.component_list], [c.__dict__ for c in rec2.component_list])
+        # Constructs outside the supported subset fall back to mcstasscript
+        merlin = os.path.join(self.rootdir, 'instruments', 'isis_merlin.instr')
+        instrfile = os.path.join(self.tmpdir.name, 'merlin_when.instr')
+        with open(merlin) as f, open(instrfile, 'w') as g:
+            g.write(f.read().replace('COMPONENT sample = Incoherent(', 'SPLIT 10 COMPONENT sample = Incoherent('))
+        with self.assertRaises(eniius.instr.UnsupportedInstr):
+            eniius.mcstas.get_instr_record(instrfile, use_cache=False, parser='native')
+        rec1 = eniius.mcstas.get_instr_record(instrfile, use_cache=False)
+        rec2 = eniius.mcstas.get_instr_record(merlin, use_cache=False, parser='native')
+        self.assertEqual([c.__dict__ for c in rec1.component_list], [c.__dict__ for c in rec2.component_list])
+        # The cached records depend on the parser requested
+        eniius.cache.clear_cache('instr')
+        rec1 = eniius.mcstas.get_instr_record(instrfile)
+        with self.assertRaises(eniius.instr.UnsupportedInstr):
+            eniius.mcstas.get_instr_record(instrfile, parser='native')
+        rec2 = eniius.mcstas.get_instr_record(instrfile, parser='mcstasscript')
+        self.assertEqual([c.__dict__ for c in rec1.component_list], [c.__dict__ for c in rec2.component_list])
+        self.assertEqual(len(eniius.mcstas.INSTR_CACHE.entries()), 2)
+
+    def test_component_index(self):
+        import mcstasscript
+        from mcstasscript.helper.component_reader import ComponentReader
+        eniius.cache.clear_cache('comps')
+        eniius.comps._INDEXES.clear()
+        index = eniius.comps.get_index()
+        self.assertEqual(len(eniius.comps.COMPS_CACHE.entries()), 1)
+        eniius.comps._INDEXES.clear()
+        self.assertEqual(eniius.comps.get_index().keys(), index.keys())
+        # The index has the same component information as mcstasscript reads from the library
+        reader = ComponentReader(eniius.mcstas.comps_path)
+        self.assertEqual(sorted(reader.component_path.keys()), sorted(index.keys()))
+        for name in index:
+            expected, info = reader.read_name(name), eniius.comps.get_component(name)
+            for attr in ['name', 'category', 'parameter_names', 'parameter_defaults', 'parameter_types']:
+                self.assertEqual(getattr(expected, attr), getattr(info, attr))
+        inst = eniius.comps.new_instr('indexed')
+        self.assertEqual(inst.add_component('slit', 'Slit').category, 'optics')
+        # The index is kept by clear_search and is not used by other mcstasscript instruments
+        inst.clear_search()
+        self.assertIsInstance(inst.component_reader, eniius.comps.IndexedComponentReader)
+        self.assertIsInstance(mcstasscript.McStas_instr('plain', package_path=eniius.mcstas.comps_path).component_reader,
+                              ComponentReader)
+        self.assertEqual(eniius.mcstas.McStasComp2NX.getNXtype(
+            eniius.mcstas.McStasCompRecord({}, name='mon', component_name='Monitor_nD', category='',
+                                           AT_data=[0, 0, 0], AT_relative='ABSOLUTE', ROTATED_data=[0, 0, 0],
+                                           ROTATED_relative='ABSOLUTE', EXTEND='')), 'NXdetector')
+
+    @staticmethod
+    def _chain_instrument(n, sample_at=None):
+        # A synthetic instrument of n components each positioned (and rotated) RELATIVE PREVIOUS
+        rng = np.random.default_rng(1)
+        return [eniius.mcstas.McStasCompRecord(
+                    {}, name=f'arm{ii}', component_name='Arm', category='samples' if ii == sample_at else 'misc',
+                    AT_data=[str(v) for v in rng.uniform(-1, 1, 3)], ROTATED_data=[str(v) for v in rng.uniform(-20, 20, 3)],
+                    AT_relative='ABSOLUTE' if ii == 0 else 'RELATIVE PREVIOUS',
+                    ROTATED_relative='ABSOLUTE' if ii == 0 else 'RELATIVE PREVIOUS', EXTEND='') for ii in range(n)]
+
+    def test_transform_chain(self):
+        for sample_at in [None, 20]:
+            components = self._chain_instrument(40, sample_at)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                nxmc = eniius.mcstas.NXMcStas(components)
+            cumulative, expected = np.eye(4), {}
+            for comp in components:
+                cumulative = np.matmul(nxmc.transforms[comp.name].transform, cumulative)
+                expected[comp.name] = cumulative
+            if sample_at is not None:
+                chain = [nxmc.transforms[c.name] for c in components[:(sample_at + 1)]]
+                rev_mat = np.linalg.multi_dot([tr.reverse().transform for tr in chain])
+            for comp in components:
+                affine = nxmc.affinelist[comp.name]
+                self.assertEqual(len(affine), 1)
+                if comp.name == nxmc.origin:
+                    np.testing.assert_allclose(affine[0].transform, np.eye(4))
+                elif sample_at is None:
+                    self.assertEqual(affine[0].depends_on, 'ABSOLUTE')
+                    np.testing.assert_allclose(affine[0].transform, expected[comp.name], atol=1e-10)
+                else:
+                    self.assertEqual(affine[0].depends_on, '.')
+                    np.testing.assert_allclose(affine[0].transform, np.matmul(expected[comp.name], rev_mat), atol=1e-10)
+
+    def test_affine_stack(self):
+        components = self._chain_instrument(30, 15)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            nxmc = eniius.mcstas.NXMcStas(components)
+        affines = [nxmc.affinelist[comp.name][0] for comp in components]
+        stack = eniius.mcstas.AffineStack.from_affines(affines)
+        euler = np.array([[float(v) for v in comp.ROTATED_data] for comp in components])
+        np.testing.assert_allclose(eniius.mcstas.AffineStack.rotmat(euler),
+                                   [eniius.mcstas.AffineRotate.rotmat(e) for e in euler])
+        np.testing.assert_allclose(eniius.mcstas.AffineStack.get_euler_angles(stack.transforms[:, :3, :3]),
+                                   [eniius.mcstas.AffineRotate.get_euler_angles(tr.transform[:3, :3]) for tr in affines])
+        fields = stack.NXfields()
+        for tr, field in zip(affines, fields):
+            expected = tr.NXfield()
+            self.assertEqual(field.transformation_type, expected.transformation_type)
+            np.testing.assert_allclose(field.nxvalue, expected.nxvalue, atol=1e-10)
+            np.testing.assert_allclose(field.vector, expected.vector, atol=1e-10)
+        np.testing.assert_allclose(eniius.mcstas.AffineStack.from_nxfields(fields).transforms, stack.transforms,
+                                   atol=1e-10)
+        # The positions recovered from the NeXus instrument match those from the individual transformations
+        nxinst = nxmc.NXinstrument()
+        mcnx = eniius.nexus.NXinst2McStas.__new__(eniius.nexus.NXinst2McStas)
+        nxtransforms = [nxinst[comp.name].transforms for comp in components]
+        for nxtr, pos in zip(nxtransforms, mcnx._get_pos_from_transforms(nxtransforms)):
+            order, _ = mcnx._get_transform_chain(nxtr)
+            transform = np.eye(4)
+            for link in eniius.mcstas.AffineStack.from_nxfields([nxtr[name] for name in order]).transforms:
+                transform = np.matmul(link, transform)
+            np.testing.assert_allclose(pos[0][1][0], transform[:3, 3], atol=1e-10)
+            if eniius.mcstas.AffineRotate(transform).is_rotation:
+                np.testing.assert_allclose(pos[1][1][0], eniius.mcstas.AffineRotate.get_euler_angles(transform[:3, :3]))
+        # The NeXus fields follow changes to the affinelist
+        name = components[3].name
+        nxmc.affinelist[name] = [eniius.mcstas.AffineRotate.from_euler_translation([0, 0, 0], [1., 2., 3.])]
+        np.testing.assert_allclose(nxmc.NXinstrument()[name].transforms[f'{name}0'].nxvalue, np.sqrt(14.))
+
+    @staticmethod
+    def _eig_axisrot(rotmat):
+        # The rotation axis and angle computed by eigendecomposition (as eniius did previously)
+        dd, vv = np.linalg.eig(rotmat)
+        axis = np.real(vv[:, np.where(np.abs(dd - 1) < 1.e-6)[0][0]])
+        angle = np.degrees(np.arccos((np.trace(rotmat) - 1.) / 2.))
+        if np.sum(np.abs(rotmat - eniius.mcstas.AffineRotate.rodrigues(axis, angle))) > 1.e-5:
+            angle = -angle
+        return axis, angle
+
+    def test_axisrot(self):
+        rng = np.random.default_rng(2)
+        euler = np.concatenate([rng.uniform(-180, 180, (200, 3)),
+                                [[180, 0, 0], [0, 0, -180], [180, 180, 0], [179.9999, 0, 0], [0, 179.99, 30]]])
+        stack = eniius.mcstas.AffineStack.from_euler_translation(euler, np.zeros((len(euler), 3)))
+        axes, angles = stack.axisrot()
+        for ii in range(len(stack)):
+            axis, angle = stack[ii].axisrot()
+            np.testing.assert_allclose(axis, axes[ii], atol=1e-12)
+            self.assertAlmostEqual(angle, angles[ii])
+            # The same rotation as before, with the angle now in [0, 180]
+            eig_axis, eig_angle = self._eig_axisrot(stack.transforms[ii, :3, :3])
+            self.assertTrue(0 <= angle <= 180)
+            if angle < 179.9:
+                np.testing.assert_allclose(axis * angle, eig_axis * eig_angle, atol=1e-6)
+        # Small angles (where arccos of the trace loses precision) and half turns are recovered accurately
+        for angle in [0, 1e-9, 1e-5, 0.1, 90, 179.9, 180 - 1e-7, 180]:
+            for axis in rng.normal(size=(5, 3)):
+                axis /= np.linalg.norm(axis)
+                tr = np.eye(4)
+                tr[:3, :3] = eniius.mcstas.AffineRotate.rodrigues(axis, angle)
+                ax, an = eniius.mcstas.AffineRotate(tr).axisrot()
+                self.assertAlmostEqual(an, angle, delta=max(1e-12, angle * 1e-9))
+                if angle == 0:
+                    np.testing.assert_allclose(ax, [1, 0, 0])
+                elif angle == 180:
+                    self.assertAlmostEqual(abs(np.dot(ax, axis)), 1, places=12)
+                else:
+                    np.testing.assert_allclose(ax, axis, atol=1e-6 if angle < 1e-6 else 1e-9)
+
+    def test_moderator_table_cache(self):
+        eniius.cache.clear_cache('moderator')
+        eniius.horace.MOD_TABLES.clear()
+        table = eniius.horace.get_moderator_table('merlin')
+        self.assertEqual(len(eniius.horace.MOD_CACHE.entries()), 1)
+        eniius.horace.MOD_TABLES.clear()
+        cached = eniius.horace.get_moderator_table('merlin')
+        self.assertTrue(isinstance(cached['intens'], np.memmap))
+        for ky in ['en', 'intens', 't']:
+            np.testing.assert_array_equal(table[ky], cached[ky])
+
+    @staticmethod
+    def _let_divergence_reference(ei, tab):
+        # The original per-row np.interp computation, read directly from the MATLAB file
+        angdeg, lam, S = tab['angdeg'][0][0].flatten(), tab['lam'][0][0].flatten(), tab['S'][0][0]
+        lam0 = np.sqrt(81.80420126 / ei)
+        profile = np.array([np.interp(lam0, lam, S[ii,:]) for ii in range(len(angdeg))])
+        return angdeg, (profile / np.sum(profile)) / np.mean(np.diff(angdeg * np.pi / 180.))
+
+    def test_let_divergence_batch(self):
+        import scipy.io
+        mat = scipy.io.loadmat(os.path.join(self.rootdir, 'instruments', 'horace_let_tables.mat'))
+        eis = np.array([2., 3.7, 10., 25.])
+        for direction in ['horiz', 'vert']:
+            tab = mat[f'ver2_{direction}_div']
+            # Also at the wavelengths of the table nodes, including both ends
+            lam = tab['lam'][0][0].flatten()
+            node_eis = 81.80420126 / (lam[[0, len(lam) // 2, -1]] * [1 + 1e-12, 1, 1 - 1e-12])**2
+            for ei_list in [eis, node_eis]:
+                angdeg, prof = eniius.horace.interp_let_divergence(ei_list, direction=direction)
+                self.assertEqual(prof.shape, (len(ei_list), len(angdeg)))
+                for ii, ei in enumerate(ei_list):
+                    ref_ang, ref_prof = self._let_divergence_reference(ei, tab)
+                    np.testing.assert_allclose(angdeg, ref_ang)
+                    np.testing.assert_allclose(prof[ii], ref_prof, rtol=1e-12, atol=1e-12)
+        for ii, ei in enumerate(eis):
+            hdiv, vdiv = eniius.horace.get_let_divergences(ei)
+            np.testing.assert_allclose(hdiv['Normalised Beam Profile'].nxdata,
+                                       self._let_divergence_reference(ei, mat['ver2_horiz_div'])[1], rtol=1e-12)
+        with self.assertRaises(RuntimeError):
+            eniius.horace.interp_let_divergence([3.7, 1.e-3])
+
+    def test_moderator_pulse_batch(self):
+        eis = np.array([5., 12.5, 80., 400.])
+        pulses, tof = eniius.horace.get_moderator_time_pulse('merlin', eis)
+        self.assertEqual(pulses.shape, (len(eis), len(tof)))
+        self.assertTrue(np.all(tof < eniius.horace.MOD_TMAX))
+        for ii, ei in enumerate(eis):
+            pulse, tof1 = eniius.horace.get_moderator_time_pulse('merlin', ei)
+            np.testing.assert_array_equal(pulse, pulses[ii])
+            np.testing.assert_array_equal(tof, tof1)
+        with self.assertRaises(RuntimeError):
+            eniius.horace.get_moderator_time_pulse('merlin', [80., 1.e12])
+
+    def test_batch_instruments(self):
+        eis = [3.7, 8., 15.]
+        lets = eniius.horace.let_instruments(eis, [[50., 300.]] * len(eis))
+        merlins = eniius.horace.merlin_instruments(eis, 300.)
+        for ii, ei in enumerate(eis):
+            let, merlin = (eniius.horace.let_instrument(ei, [50., 300.]), eniius.horace.merlin_instrument(ei, 300.))
+            self.assertEqual(lets[ii]['fermi/energy'].nxvalue, ei)
+            self.assertEqual(lets[ii]['mono_chopper/rotation_speed'].nxvalue, 300.)
+            np.testing.assert_allclose(lets[ii]['horiz_div/data'].nxsignal.nxdata, let['horiz_div/data'].nxsignal.nxdata)
+            self.assertEqual(merlins[ii]['fermi/energy'].nxvalue, ei)
+            self.assertEqual(merlins[ii]['fermi/rotation_speed'].nxvalue, 300.)
+            np.testing.assert_allclose(merlins[ii]['moderator/pulse_shape'].nxsignal.nxdata,
+                                       merlin['moderator/pulse_shape'].nxsignal.nxdata)
+            self.assertEqual(list(merlins[ii].keys()), list(merlin.keys()))
+        with self.assertRaises(RuntimeError):
+            eniius.horace.maps_instruments(eis, [100., 200.])
+
+    def test_read_detector_dat(self):
+        titles, tables = eniius.writer.read_detector_dat(self.detdat)
+        self.assertEqual(titles, 'W_x,W_y,W_z,a_x,a_y,a_z,det1,det2,det3')
+        self.assertEqual(tables['monitors'].shape, (4, 15))
+        self.assertEqual(tables['detectors'].shape, (918, 15))
+        self.assertTrue(np.all(tables['detectors'][:,3] == 2))
+        detdat = np.loadtxt(self.detdat, skiprows=3)
+        np.testing.assert_array_equal(tables['detectors'], detdat[detdat[:,3] == 2,:])
+        rv = eniius.writer.Writer(nexus.NXinstrument())._parse_det(self.detdat)
+        dets = rv['instrument/physical_detectors']
+        self.assertEqual(dets['number_of_detectors'].nxvalue, 918)
+        self.assertEqual(dets['detector_number'].dtype, np.int32)
+        self.assertEqual(dets['user_table_9'].shape, (918,))
+
+    def test_detector_cache(self):
+        eniius.cache.clear_cache('detector')
+        titles, tables = eniius.writer.read_detector_dat(self.detdat)
+        self.assertEqual(len(eniius.writer.DET_CACHE.entries()), 1)
+        titles2, tables2 = eniius.writer.read_detector_dat(self.detdat)
+        self.assertEqual(titles, titles2)
+        for fnm in ['detectors', 'monitors']:
+            self.assertTrue(isinstance(tables2[fnm], np.memmap))
+            np.testing.assert_array_equal(tables[fnm], tables2[fnm])
+        eniius.writer.DET_CACHE.invalidate(eniius.writer.DET_CACHE.key(self.detdat))
+        self.assertEqual(len(eniius.writer.DET_CACHE.entries()), 0)
+
+    def test_stream_json(self):
+        inst = nexus.NXinstrument()
+        inst['source'] = nexus.NXsource(name=nexus.NXfield('ISIS', attrs={'short_name':'ISIS'}))
+        inst['detector'] = nexus.NXdetector(polar_angle=nexus.NXfield(np.random.rand(1000)*100, units='degree'),
+                                            distance=nexus.NXfield(np.random.rand(10, 4, 3)),
+                                            detector_number=np.arange(1000, dtype=np.int32))
+        inst['empty'] = nexus.NXcollection()
+        writer = eniius.writer.Writer(inst)
+        reffile, streamfile = [os.path.join(self.tmpdir.name, f'{fn}.json') for fn in ['ref', 'stream']]
+        for indent in [4, None]:
+            writer.to_json(reffile, indent=indent)
+            writer.to_json(streamfile, stream=True, indent=indent)
+            with open(reffile) as f1, open(streamfile) as f2:
+                self.assertEqual(f1.read(), f2.read())
+        # A tree which cannot be converted leaves no (partial) output file and does not replace an existing one
+        inst['bad'] = nexus.NXfield(np.array([object()], dtype=object))
+        badfile = os.path.join(self.tmpdir.name, 'bad.json')
+        for stream in [False, True]:
+            with self.assertRaises(RuntimeError):
+                writer.to_json(badfile, stream=stream)
+            self.assertFalse(os.path.exists(badfile))
+        with self.assertRaises(RuntimeError):
+            writer.to_json(streamfile, stream=True)
+        with open(reffile) as f1, open(streamfile) as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertEqual([fn for fn in os.listdir(self.tmpdir.name) if fn.endswith('.tmp')], [])
+
+    def _h5_contents(self, filename):
+        # Returns (path, shape, dtype) of every object and (path, name, value, type) of every attribute
+        contents = []
+        def visit(name, obj):
+            contents.append((name,) + ((obj.shape, obj.dtype) if isinstance(obj, h5py.Dataset) else ()))
+            for k, v in obj.attrs.items():
+                contents.append((name, k, str(v), obj.attrs.get_id(k).get_type().get_class()))
+        with h5py.File(filename, 'r') as f:
+            f.visititems(visit)
+        return sorted(contents, key=str)
+
+    def test_h5py_backend(self):
+        wrapper = eniius.Eniius(eniius.horace.merlin_instrument(180.), self.detdat)
+        files = {bk:os.path.join(self.tmpdir.name, f'{bk}.nxs') for bk in ['nexus', 'h5py']}
+        for bk, fn in files.items():
+            wrapper.to_icp(fn, backend=bk)
+        self.assertEqual(self._h5_contents(files['nexus']), self._h5_contents(files['h5py']))
+        with h5py.File(files['h5py'], 'r') as f:
+            self.assertEqual(f['mantid_workspace_1/instrument'].attrs['NX_class'].dtype.kind, 'S')
+            np.testing.assert_array_equal(f['mantid_workspace_1/instrument/physical_detectors/polar_angle'][()],
+                                          eniius.writer.read_detector_dat(self.detdat)[1]['detectors'][:,4])
+        files = {bk:os.path.join(self.tmpdir.name, f'{bk}.nxspe') for bk in ['nexus', 'h5py']}
+        for bk, fn in files.items():
+            wrapper.to_nxspe(fn, backend=bk)
+        self.assertEqual(*[[c for c in self._h5_contents(fn) if not c[0].startswith('w1/data')]
+                           for fn in files.values()])
+
+    def test_nxspe_storage(self):
+        ndet, nen = 918, 400
+        data = nexus.NXdata(data=nexus.NXfield(np.random.rand(ndet, nen), axes='polar:energy', signal=1),
+                            error=np.random.rand(ndet, nen), energy=nexus.NXfield(np.linspace(0, 150, nen), units='meV'))
+        wrapper = eniius.Eniius(nexus.NXentry(instrument=eniius.horace.merlin_instrument(180.), data=data), self.detdat)
+        nxspefile = os.path.join(self.tmpdir.name, 'storage.nxspe')
+        for backend in ['nexus', 'h5py']:
+            wrapper.to_nxspe(nxspefile, backend=backend)
+            with h5py.File(nxspefile, 'r') as f:
+                for dset in ['data', 'error']:
+                    # Chunks have all energies for a block of detectors
+                    self.assertEqual(f[f'w1/data/{dset}'].chunks[1], nen)
+                    self.assertEqual(f[f'w1/data/{dset}'].compression, 'gzip')
+                np.testing.assert_array_equal(f['w1/data/data'][()], data['data'].nxdata)
+                self.assertIsNone(f['w1/data/energy'].compression)
+            wrapper.to_nxspe(nxspefile, backend=backend, storage={'data':'lzf', 'detector':{'compression':'gzip'}})
+            with h5py.File(nxspefile, 'r') as f:
+                self.assertEqual(f['w1/data/error'].compression, 'lzf')
+                self.assertEqual(f['w1/instrument/physical_detectors/polar_angle'].compression, 'gzip')
+                self.assertEqual(f['w1/instrument/physical_detectors/polar_angle'].chunks, (ndet,))
+            for storage in [None, {}, {'data':{}}]:
+                wrapper.to_nxspe(nxspefile, backend=backend, storage=storage)
+                with h5py.File(nxspefile, 'r') as f:
+                    self.assertIsNone(f['w1/data/data'].chunks)
+                    self.assertIsNone(f['w1/data/data'].compression)
+            with self.assertRaises(RuntimeError):
+                wrapper.to_nxspe(nxspefile, backend=backend, storage={'data':'lzf', 'compression':'gzip'})
+        # Data in a file is copied in blocks of detectors, without reading the whole array into memory
+        srcfile = os.path.join(self.tmpdir.name, 'storage_src.nxs')
+        nexus.NXroot(entry=nexus.NXentry(instrument=eniius.horace.merlin_instrument(180.), data=data)).save(srcfile, 'w')
+        for backend in ['nexus', 'h5py']:
+            src = nexus.nxload(srcfile)
+            eniius.Eniius(src['entry'], ei=180.).to_nxspe(nxspefile, backend=backend)
+            self.assertIsNone(src['entry/data/data']._value)
+            with h5py.File(nxspefile, 'r') as f:
+                np.testing.assert_array_equal(f['w1/data/data'][()], data['data'].nxdata)
+                self.assertEqual(f['w1/data/data'].compression, 'gzip')
+
+    def test_instrument_template(self):
+        writer = eniius.writer.Writer(eniius.horace.merlin_instrument(180.))
+        template = os.path.join(self.tmpdir.name, 'merlin_template.h5')
+        files = {ky:os.path.join(self.tmpdir.name, f'{ky}.nxs') for ky in ['direct', 'copy', 'link']}
+        writer.to_icp(files['direct'], self.detdat, backend='h5py')
+        writer.to_icp(files['copy'], self.detdat, template=template)
+        self.assertTrue(os.path.exists(template))
+        self.assertEqual(self._h5_contents(files['direct']), self._h5_contents(files['copy']))
+        writer.to_icp(files['link'], self.detdat, template=template, link=True)
+        with h5py.File(files['link'], 'r') as f:
+            link = f['mantid_workspace_1'].get('instrument', getlink=True)
+            self.assertTrue(isinstance(link, h5py.ExternalLink))
+            self.assertEqual(f['mantid_workspace_1/instrument/physical_detectors/number_of_detectors'][()], 918)
+        writer.to_nxspe(os.path.join(self.tmpdir.name, 'template.nxspe'), 180., self.detdat, template=template)
+        with h5py.File(os.path.join(self.tmpdir.name, 'template.nxspe'), 'r') as f:
+            self.assertEqual(f['w1/instrument/fermi/energy'][()], 180.)
+        # A template for another instrument (here Ei) or detector.dat is rebuilt rather than reused
+        self.assertFalse(writer.update_template(template, self.detdat))
+        writer2 = eniius.writer.Writer(eniius.horace.merlin_instrument(120.))
+        writer2.to_nxspe(os.path.join(self.tmpdir.name, 'template.nxspe'), 120., self.detdat, template=template,
+                         storage={'data':'lzf'})
+        with h5py.File(os.path.join(self.tmpdir.name, 'template.nxspe'), 'r') as f:
+            self.assertEqual(f['w1/instrument/fermi/energy'][()], 120.)
+            self.assertEqual(f['w1/data/data'].compression, 'lzf')
+        self.assertTrue(writer2.update_template(template))
+        with h5py.File(template, 'r') as f:
+            self.assertNotIn('physical_detectors', f['instrument'])
+        # Options which the template would ignore are errors
+        for kwargs in [{'backend':'nexus'}, {'storage':'gzip'}, {'storage':{'detector':None}}]:
+            with self.assertRaises(RuntimeError):
+                writer.to_nxspe(os.path.join(self.tmpdir.name, 'template.nxspe'), 180., self.detdat,
+                                template=template, **kwargs)
+        with self.assertRaises(RuntimeError):
+            writer.to_icp(files['copy'], self.detdat, backend='nexus', template=template)
+
+    def test_inject_instrument(self):
+        rawfile = os.path.join(self.tmpdir.name, 'raw.nxs')
+        events = np.random.rand(100000)
+        with h5py.File(rawfile, 'w') as f:
+            entry = f.create_group('raw_data_1')
+            entry.attrs['NX_class'] = b'NXentry'
+            entry['events'] = events
+            entry.create_group('instrument')['old_field'] = 1.
+        wrapper = eniius.Eniius(eniius.horace.merlin_instrument(180.), self.detdat)
+        self.assertTrue(wrapper.inject(rawfile))
+        mtime = os.stat(rawfile).st_mtime_ns
+        self.assertFalse(wrapper.inject(rawfile))
+        self.assertEqual(os.stat(rawfile).st_mtime_ns, mtime)
+        with h5py.File(rawfile, 'r') as f:
+            np.testing.assert_array_equal(f['raw_data_1/events'][()], events)
+            self.assertNotIn('old_field', f['raw_data_1/instrument'])
+            self.assertEqual(f['raw_data_1/instrument/fermi/energy'][()], 180.)
+        self.assertTrue(eniius.Eniius(eniius.horace.merlin_instrument(120.), self.detdat).inject(rawfile))
+        with h5py.File(rawfile, 'r') as f:
+            self.assertEqual(f['raw_data_1/instrument/fermi/energy'][()], 120.)
+        with self.assertRaises(RuntimeError):
+            wrapper.inject(rawfile, entry='mantid_workspace_1')
+        # Injecting a copied template stores the checksum of the group written (a stale template is rebuilt)
+        template = os.path.join(self.tmpdir.name, 'inject_template.h5')
+        wrapper.writer.write_template(template, self.detdat)
+        self.assertTrue(wrapper.inject(rawfile, template=template))
+        self.assertFalse(wrapper.inject(rawfile))
+        wrapper120 = eniius.Eniius(eniius.horace.merlin_instrument(120.), self.detdat)
+        self.assertTrue(wrapper120.inject(rawfile, template=template))
+        with h5py.File(rawfile, 'r') as f, h5py.File(template, 'r') as t:
+            self.assertEqual(f['raw_data_1/instrument/fermi/energy'][()], 120.)
+            self.assertEqual(f['raw_data_1/instrument'].attrs['eniius_checksum'], t['instrument'].attrs['eniius_checksum'])
+            np.testing.assert_array_equal(f['raw_data_1/events'][()], events)
+        self.assertFalse(wrapper120.inject(rawfile))
+
+    def test_ibex_strings_scoped(self):
+        plainfile, ibexfile = [os.path.join(self.tmpdir.name, f'{fn}.nxs') for fn in ['plain', 'ibex']]
+        nexus.NXroot(entry=nexus.NXentry(title=nexus.NXfield('MERLIN'))).save(plainfile, 'w')
+        with eniius.writer.ibex_strings():
+            nexus.NXroot(entry=nexus.NXentry(title=nexus.NXfield('MERLIN'), names=np.array(['a', 'bc']))).save(ibexfile, 'w')
+        self.assertIs(nexus.tree.NXFile._writedata, eniius.writer._writedata)
+        with h5py.File(plainfile, 'r') as f:
+            self.assertTrue(h5py.check_string_dtype(f['entry/title'].dtype).length is None)
+            self.assertIsInstance(f['entry'].attrs['NX_class'], str)
+        with h5py.File(ibexfile, 'r') as f:
+            self.assertEqual(f['entry/title'].dtype, np.dtype('S6'))
+            self.assertEqual(f['entry/title'].shape, (1,))
+            self.assertEqual(f['entry/names'][()].tolist(), [b'a', b'bc'])
+            self.assertEqual(f['entry'].attrs['NX_class'], b'NXentry')
+
+    def test_memoised_writer(self):
+        wrapper = eniius.Eniius(eniius.horace.merlin_instrument(180.), self.detdat)
+        nxsfile = os.path.join(self.tmpdir.name, 'memo.nxs')
+        writer = wrapper.writer
+        wrapper.to_icp(nxsfile)
+        wrapper.to_nxspe(nxsfile)
+        self.assertIs(wrapper.writer, writer)
+        self.assertIn(self.detdat, writer._det)
+        wrapper.nxs_obj['fermi/energy'] = 120.
+        self.assertIsNot(wrapper.writer, writer)
+        wrapper.to_icp(nxsfile)
+        with h5py.File(nxsfile, 'r') as f:
+            self.assertEqual(f['mantid_workspace_1/instrument/fermi/energy'][()], 120.)
+        for attr, value in [('ei', 120.), ('detector_dat', None), ('nxs_obj', eniius.horace.let_instrument(3.7))]:
+            writer = wrapper.writer
+            setattr(wrapper, attr, value)
+            self.assertIsNot(wrapper.writer, writer)
+
+    @staticmethod
+    def _write_spe(filename, signal, error, energy):
+        block = lambda v: '\n'.join([''.join([f'{x:10.3E}' for x in v[i:(i+8)]]) for i in range(0, len(v), 8)]) + '\n'
+        with open(filename, 'w') as f:
+            f.write(f'{signal.shape[0]:8d}{signal.shape[1]:8d}\n### Phi Grid\n' + block(np.arange(signal.shape[0] + 1)))
+            f.write('### Energy Grid\n' + block(energy))
+            for sig, err in zip(signal, error):
+                f.write('### S(Phi,w)\n' + block(sig) + '### Errors\n' + block(err))
+
+    def test_nxspe_streaming(self):
+        ndet, nen = 250, 37
+        signal, error = -np.random.rand(ndet, nen) * 100, np.random.rand(ndet, nen)
+        energy = np.linspace(-5, 150, nen + 1)
+        spefile, nxspefile = [os.path.join(self.tmpdir.name, f'stream.{ext}') for ext in ['spe', 'nxspe']]
+        self._write_spe(spefile, signal, error, energy)
+        blocks = list(eniius.spe.iter_spe(spefile, block_size=100))
+        self.assertEqual([len(b[0]) for b in blocks], [100, 100, 50])
+        np.testing.assert_allclose(np.concatenate([b[0] for b in blocks]), signal, rtol=1e-3)
+        wrapper = eniius.Eniius(eniius.horace.merlin_instrument(180.), self.detdat)
+        memmap = np.lib.format.open_memmap(os.path.join(self.tmpdir.name, 'signal.npy'), 'w+', np.float64, (ndet, nen))
+        memmap[:] = signal
+        gen = lambda: ((signal[i:(i+60)], error[i:(i+60)]) for i in range(0, ndet, 60))
+        for backend in ['nexus', 'h5py']:
+            for data in [spefile, eniius.NXSPEData.from_arrays(memmap, memmap, energy, block_size=32),
+                         eniius.NXSPEData(ndet, nen, energy, gen, polar=np.arange(ndet))]:
+                wrapper.to_nxspe(nxspefile, backend=backend, data=data)
+                with h5py.File(nxspefile, 'r') as f:
+                    self.assertEqual(f['w1/data/data'].shape, (ndet, nen))
+                    np.testing.assert_allclose(f['w1/data/data'][()], signal, rtol=1e-3)
+                    np.testing.assert_allclose(f['w1/data/energy'][()], energy, rtol=1e-3)
+                    self.assertEqual(f['w1/instrument/fermi/energy'][()], 180.)
+        with self.assertRaises(RuntimeError):
+            wrapper.to_nxspe(nxspefile, data=eniius.NXSPEData(ndet + 1, nen, energy, [(signal, error)]))
+        # Trailing whitespace on a line is ignored and values of other widths are read if separated by spaces
+        parse = eniius.spe._parse_values
+        np.testing.assert_array_equal(parse([' 1.000E+00 2.000E+00-3.000E+00       NaN \n'], 4), [1, 2, -3, np.nan])
+        np.testing.assert_array_equal(parse([' 1.000E+00 2.000E+00\r\n', '-3.0  4.5\n'], 4), [1, 2, -3, 4.5])
+        with self.assertRaises(RuntimeError):
+            parse([' 1.000E+00 2.000E+00-3.000E+00\n'], 4)
+
+    def test_nxspe_reference(self):
+        ndet, nen = 2000, 200
+        signal, error = np.random.rand(ndet, nen), np.random.rand(ndet, nen)
+        srcdir = os.path.join(self.tmpdir.name, 'reduced')
+        os.makedirs(srcdir, exist_ok=True)
+        srcfile, nxspefile, icpfile = [os.path.join(srcdir, fn) for fn in ['run.h5', 'ref.nxspe', 'ref.nxs']]
+        with h5py.File(srcfile, 'w') as f:
+            f['signal'], f['error'], f['polar'] = signal, error, np.arange(ndet, dtype=np.float64)
+        wrapper = eniius.Eniius(eniius.horace.merlin_instrument(180.), self.detdat)
+        wrapper.to_icp(icpfile)
+        energy = np.linspace(-5, 150, nen + 1)
+        for backend in ['nexus', 'h5py']:
+            for link in [False, True]:
+                data = eniius.NXSPEReference((srcfile, 'signal'), (srcfile, 'error'), energy, link=link,
+                                             polar=(srcfile, 'polar'))
+                wrapper.to_nxspe(nxspefile, backend=backend, data=data)
+                self.assertLess(os.path.getsize(nxspefile), signal.nbytes)
+                # Sources are found relative to the NXSPE file
+                cwd = os.getcwd()
+                try:
+                    os.chdir(self.tmpdir.name)
+                    with h5py.File(nxspefile, 'r') as f:
+                        self.assertEqual(f['w1/data/data'].is_virtual, not link)
+                        np.testing.assert_allclose(f['w1/data/data'][()], signal)
+                        np.testing.assert_allclose(f['w1/data/errors'][()], error)
+                        np.testing.assert_allclose(f['w1/data/polar'][()], np.arange(ndet))
+                        np.testing.assert_allclose(f['w1/data/energy'][()], energy)
+                finally:
+                    os.chdir(cwd)
+        # Detector tables can be referenced from an existing HDF5 file
+        eniius.Eniius(wrapper.nxs_obj, icpfile).to_nxspe(nxspefile)
+        with h5py.File(nxspefile, 'r') as f, h5py.File(icpfile, 'r') as g:
+            dets = f['w1/instrument/physical_detectors']
+            self.assertTrue(all([dets[k].is_virtual for k in dets if dets[k].dtype.kind == 'f']))
+            np.testing.assert_allclose(dets['distance'][()],
+                                       g['mantid_workspace_1/instrument/physical_detectors/distance'][()])
+
+    def test_export(self):
+        wrapper = eniius.Eniius(eniius.horace.merlin_instrument(180.), self.detdat)
+        wrapper.to_icp(os.path.join(self.tmpdir.name, 'sequential.nxs'))
+        for parallel in [None, 'thread', 'process']:
+            timings = wrapper.export(os.path.join(self.tmpdir.name, 'export'), ['icp', 'nxspe'], parallel=parallel)
+            self.assertEqual(sorted(timings.keys()), ['icp', 'nxspe', 'total'])
+            self.assertEqual(self._h5_contents(os.path.join(self.tmpdir.name, 'sequential.nxs')),
+                             self._h5_contents(os.path.join(self.tmpdir.name, 'export.nxs')))
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name, 'export.nxspe')))
+        with self.assertRaises(RuntimeError):
+            wrapper.export(os.path.join(self.tmpdir.name, 'export'), ['spe'])
+        # A filename with an output extension is the base name of all outputs; the JSON indent is passed through
+        wrapper = eniius.Eniius.from_mcstas(os.path.join(self.rootdir, 'instruments', 'isis_merlin.instr'),
+                                            self.detdat, ei=180.)
+        wrapper.to_icp(os.path.join(self.tmpdir.name, 'sequential.nxs'))
+        wrapper.to_json(os.path.join(self.tmpdir.name, 'sequential.json'), indent=None)
+        wrapper.export(os.path.join(self.tmpdir.name, 'named.nxs'), indent=None)
+        self.assertEqual(sorted([fn for fn in os.listdir(self.tmpdir.name) if fn.startswith('named')]),
+                         ['named.json', 'named.nxs', 'named.nxspe'])
+        with open(os.path.join(self.tmpdir.name, 'sequential.json')) as f1, \
+                open(os.path.join(self.tmpdir.name, 'named.json')) as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertEqual(self._h5_contents(os.path.join(self.tmpdir.name, 'sequential.nxs')),
+                         self._h5_contents(os.path.join(self.tmpdir.name, 'named.nxs')))
+        # Detector tables can be referenced from an existing HDF5 file
+        h5wrapper = eniius.Eniius(wrapper.nxs_obj, os.path.join(self.tmpdir.name, 'sequential.nxs'), ei=180.)
+        h5wrapper.export(os.path.join(self.tmpdir.name, 'h5det'), ['icp', 'nxspe'], backend='h5py')
+        with h5py.File(os.path.join(self.tmpdir.name, 'h5det.nxspe'), 'r') as f, \
+                h5py.File(os.path.join(self.tmpdir.name, 'sequential.nxs'), 'r') as g:
+            np.testing.assert_allclose(f['w1/instrument/physical_detectors/distance'][()],
+                                       g['mantid_workspace_1/instrument/physical_detectors/distance'][()])
+        self.assertEqual(self._h5_contents(os.path.join(self.tmpdir.name, 'h5det.nxs')),
+                         self._h5_contents(os.path.join(self.tmpdir.name, 'sequential.nxs')))
+
+    def test_submit_export(self):
+        import threading, time, concurrent.futures
+        wrapper = eniius.Eniius(eniius.horace.merlin_instrument(180.), self.detdat)
+        stages = []
+        future = wrapper.submit('icp', os.path.join(self.tmpdir.name, 'background'), backend='h5py',
+                                progress=lambda stage, fraction: stages.append((stage, fraction)))
+        outfile = future.result(timeout=60)
+        self.assertEqual(outfile, os.path.join(self.tmpdir.name, 'background.nxs'))
+        self.assertEqual(stages[0], ('start', 0.))
+        self.assertEqual(stages[-1], ('done', 1.))
+        self.assertTrue(('detectors', 1.) in stages)
+        wrapper.to_icp(os.path.join(self.tmpdir.name, 'foreground'), backend='h5py')
+        self.assertEqual(self._h5_contents(outfile), self._h5_contents(os.path.join(self.tmpdir.name, 'foreground.nxs')))
+        # A running export is cancelled at once and stopped at its next progress point; its partial output is
+        # removed and an existing file of the same name is left untouched
+        cancelledfile = os.path.join(self.tmpdir.name, 'cancelled.nxspe')
+        with open(cancelledfile, 'w') as f:
+            f.write('existing')
+        started, resume, callbacks = threading.Event(), threading.Event(), []
+        def blocks():
+            for i in range(10):
+                if i == 1:
+                    started.set()
+                    resume.wait(timeout=60)
+                yield np.ones((10, 5)), np.ones((10, 5))
+        data = eniius.NXSPEData(100, 5, np.arange(6.), blocks)
+        future = wrapper.submit('nxspe', os.path.join(self.tmpdir.name, 'cancelled'), backend='h5py', data=data)
+        future.add_done_callback(callbacks.append)
+        self.assertTrue(started.wait(timeout=60))
+        # Threads already waiting on the running export are notified by the cancel
+        waited, other = {}, concurrent.futures.Future()
+        waiters = [threading.Thread(target=lambda: waited.update(wait=concurrent.futures.wait(
+                       [future, other], timeout=60, return_when=concurrent.futures.FIRST_COMPLETED))),
+                   threading.Thread(target=lambda: waited.update(as_completed=list(
+                       concurrent.futures.as_completed([future], timeout=60))))]
+        for thread in waiters:
+            thread.start()
+        time.sleep(0.2)
+        self.assertTrue(future.cancel())
+        for thread in waiters:
+            thread.join(timeout=60)
+        self.assertEqual(waited['wait'].done, {future})
+        self.assertEqual(waited['as_completed'], [future])
+        self.assertTrue(future.cancelled() and future.done())
+        self.assertEqual(callbacks, [future])
+        self.assertEqual(concurrent.futures.wait([future], timeout=0).done, {future})
+        with self.assertRaises(concurrent.futures.CancelledError):
+            future.result(timeout=0)
+        resume.set()
+        for _ in range(600):
+            if not [fn for fn in os.listdir(self.tmpdir.name) if fn.startswith('cancelled.') and '.tmp' in fn]:
+                break
+            time.sleep(0.1)
+        self.assertEqual(future.stage, 'data')
+        self.assertEqual(sorted([fn for fn in os.listdir(self.tmpdir.name) if fn.startswith('cancelled')]),
+                         ['cancelled.nxspe'])
+        with open(cancelledfile) as f:
+            self.assertEqual(f.read(), 'existing')
+        # A failed export also leaves an existing file untouched
+        future = wrapper.submit('nxspe', cancelledfile, backend='h5py', storage='unknown')
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=60)
+        with open(cancelledfile) as f:
+            self.assertEqual(f.read(), 'existing')
+        self.assertFalse(future.cancel())
+
     def test_save_nxs_from_mcstas(self):
         nxsfile = os.path.join(self.tmpdir.name, 'mcstas.nxs')
         instrfile = os.path.join(self.rootdir, 'instruments', 'isis_merlin.instr')